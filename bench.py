@@ -0,0 +1,450 @@
+#!/usr/bin/env python
+
+# Benchmarks for each stage of the service, from encoding to the end-to-end
+# latency of a plugin line.  Every corpus is generated from a fixed seed so
+# runs can be compared:
+#
+#     python bench.py [--json results.json] [benchmark ...]
+
+import argparse
+import json
+import logging
+import os
+import os.path
+import platform
+import Queue
+import random
+import resource
+import shutil
+import signal
+import string
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
+
+import morse
+import normalize
+import sound
+
+sys.path.append(os.path.join(os.path.dirname(__file__), 'thirdparty'))
+import pymorse
+
+LENGTHS = [10, 100, 1000, 10000]
+
+def corpus(length, seed=0):
+	rng = random.Random(seed)
+	alphabet = string.ascii_uppercase + string.digits + '      '
+	return ''.join(rng.choice(alphabet) for _ in range(length))
+
+PREFIXES = [u'', u'', u'', u'Re: ', u'Fwd: ', u'RE: Re: ', u'[ALERT] ']
+SUBJECT_WORDS = u'build failed passed on master deploy to production disk usage at percent on host daily report for weekly meeting notes invoice payment received your order has shipped password reset request new comment pull request review'.split()
+UNICODE_WORDS = [u'caf\xe9', u'r\xe9sum\xe9', u'na\xefve', u'Stra\xdfe', u'\xc5ngstr\xf6m', u'se\xf1or', u'\u041f\u0440\u0438\u0432\u0435\u0442', u'\u6771\u4eac', u'\u03b1\u03b2\u03b3', u'\u2713', u'\u201cquoted\u201d', u'\u2014']
+
+# Lines that look like email subjects and alerts
+def subjects(count, seed=0):
+	rng = random.Random(seed)
+	lines = []
+	for _ in range(count):
+		words = [rng.choice(SUBJECT_WORDS) for _ in range(rng.randint(3, 9))]
+		if rng.random() < 0.5:
+			words.insert(rng.randint(0, len(words)), unicode(rng.randint(1, 9999)))
+		lines.append(rng.choice(PREFIXES) + u' '.join(words).capitalize())
+	return lines
+
+# The same, with about a third of the words accented or in other scripts
+def unicodeSubjects(count, seed=0):
+	rng = random.Random(seed)
+	return [u' '.join(rng.choice(UNICODE_WORDS) if rng.random() < 0.3 else word for word in line.split()) for line in subjects(count, seed)]
+
+def timed(function, *args):
+	best = None
+	repeat = 3
+	for _ in range(repeat):
+		start = time.time()
+		function(*args)
+		elapsed = time.time() - start
+		best = elapsed if best is None else min(best, elapsed)
+	return best
+
+# Runs function in a child process and returns how much it raised the peak
+# resident size, in kilobytes, so no measurement inherits another's peak
+def peakMemory(function, *args):
+	(read, write) = os.pipe()
+	pid = os.fork()
+	if pid == 0:
+		try:
+			os.close(read)
+			before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+			function(*args)
+			after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+			os.write(write, str(after - before))
+		finally:
+			os._exit(0)
+	os.close(write)
+	data = ''
+	while True:
+		chunk = os.read(read, 64)
+		if not chunk:
+			break
+		data += chunk
+	os.close(read)
+	os.waitpid(pid, 0)
+	return int(data) if data else None
+
+def renderers(farnsworth=False):
+	yield ('samples', sound.bank)
+	try:
+		import synth
+	except ImportError:
+		return
+	yield ('synth', synth.Synthesizer())
+	if farnsworth:
+		yield ('farnsworth', synth.Synthesizer(25, 12))
+
+def benchRender(lengths=LENGTHS):
+	encoder = pymorse.MorseCode(strict_mode=False)
+	results = []
+	for (name, renderer) in renderers():
+		for length in lengths:
+			morseCode = encoder.to_morse(corpus(length))
+			elapsed = timed(renderer.render, morseCode)
+			results.append({
+				'renderer': name,
+				'length': length,
+				'symbols': len(morseCode),
+				'seconds': elapsed,
+				'secondsPerSymbol': elapsed / max(1, len(morseCode)),
+				'peakKilobytes': peakMemory(renderer.render, morseCode),
+			})
+	return results
+
+# Time from handing a message to the sink until it returns, across a burst.
+# Stand-in players are used so this runs without audio hardware.
+def benchSink(burst=50):
+	encoder = pymorse.MorseCode(strict_mode=False)
+	(params, frames) = sound.bank.render(encoder.to_morse('Hello World'))
+	sinks = [
+		('tempfile', sound.TempFileSink(player=lambda filename: subprocess.check_call(['cat', filename], stdout=open(os.devnull, 'wb')))),
+		('pipe', sound.PipeSink(lambda format: ['sh', '-c', 'cat > ' + os.devnull])),
+	]
+	results = []
+	for (name, sink) in sinks:
+		latencies = []
+		for _ in range(burst):
+			start = time.time()
+			sink.write(params, frames)
+			latencies.append(time.time() - start)
+		sink.close()
+		results.append({
+			'sink': name,
+			'messages': burst,
+			'burstSeconds': sum(latencies),
+			'median': sorted(latencies)[len(latencies) // 2],
+		})
+	return results
+
+def benchEncode(count=2000, length=60):
+	texts = [corpus(length, seed) for seed in range(count)]
+	baseline = pymorse.MorseCode(strict_mode=False)
+	compiled = morse.CompiledMorseCode(strict_mode=False)
+	results = [
+		{'corpus': 'random', 'encoder': 'pymorse', 'messages': count, 'seconds': timed(lambda: [baseline.to_morse(text) for text in texts])},
+		{'corpus': 'random', 'encoder': 'compiled', 'messages': count, 'seconds': timed(lambda: [compiled.to_morse(text) for text in texts])},
+		{'corpus': 'random', 'encoder': 'compiled-batch', 'messages': count, 'seconds': timed(compiled.to_morse_many, texts)},
+	]
+	lines = subjects(count)
+	# pymorse would log a warning for every bracket in the subjects
+	logging.getLogger('MorseCode').setLevel(logging.ERROR)
+	results.append({'corpus': 'subjects', 'encoder': 'pymorse', 'messages': count, 'seconds': timed(lambda: [baseline.to_morse(line.encode('ascii')) for line in lines])})
+	results.append({'corpus': 'subjects', 'encoder': 'compiled', 'messages': count, 'seconds': timed(lambda: [compiled.to_morse(line) for line in lines])})
+	# pymorse cannot log unencodable unicode, so only the compiled encoder
+	# takes the unicode corpus, as is and downconverted as the service does
+	lines = unicodeSubjects(count)
+	results.append({'corpus': 'unicode', 'encoder': 'compiled', 'messages': count, 'seconds': timed(lambda: [compiled.to_morse(line) for line in lines])})
+	normalizer = normalize.Normalizer()
+	results.append({'corpus': 'unicode', 'encoder': 'compiled+normalize', 'messages': count, 'seconds': timed(lambda: [compiled.to_morse(normalizer.normalize(line)) for line in lines])})
+	try:
+		import unidecode
+	except ImportError:
+		pass
+	else:
+		results.append({'corpus': 'unicode', 'encoder': 'compiled+unidecode', 'messages': count, 'seconds': timed(lambda: [compiled.to_morse(unidecode.unidecode(line)) for line in lines])})
+	return results
+
+# Decoding a few megabytes of morse in one string versus as a stream of
+# 64KB chunks.  B, C and 8 are left out of the corpus because their entries
+# in pymorse contain spaces, which from_morse cannot decode.
+def benchDecode(characters=500000, chunkSize=65536):
+	rng = random.Random(0)
+	alphabet = ''.join(c for c in string.ascii_uppercase + string.digits if c not in 'BC8') + '      '
+	code = pymorse.MorseCode()
+	morseCode = code.to_morse(''.join(rng.choice(alphabet) for _ in range(characters)))
+	chunks = lambda: (morseCode[i:i + chunkSize] for i in range(0, len(morseCode), chunkSize))
+	return [
+		{'decoder': 'from_morse', 'bytes': len(morseCode), 'seconds': timed(code.from_morse, morseCode)},
+		{'decoder': 'stream', 'bytes': len(morseCode), 'seconds': timed(lambda: ''.join(morse.decodeStream(chunks(), code)))},
+	]
+
+# Text which every renderer's output must decode back to, and pymorse's
+# entries with stray spaces in them, which come back as several characters
+# and so only match once the spaces are ignored
+ROUND_TRIP = 'PARIS SOS 73 QUIZ JUMPY FOX WALTZ 1234567 90 DEV'
+SPLIT = {'B': 'NEE', 'C': 'C', '8': 'OI'}
+SPLIT_TRIP = 'THE QUICK BROWN FOX 8'
+
+# Renders ROUND_TRIP and SPLIT_TRIP with sound.play() through the sample
+# bank and the synthesizer, including Farnsworth spacing, and checks that
+# receive.decodeFile() returns them
+def checkRoundTrip():
+	import receive
+	encoder = morse.CompiledMorseCode(strict_mode=False)
+	expected = ''.join(SPLIT.get(char, char) for char in SPLIT_TRIP)
+	for (name, renderer) in renderers(farnsworth=True):
+		for text in (ROUND_TRIP, SPLIT_TRIP):
+			filename = tempfile.NamedTemporaryFile(suffix='.wav').name
+			sink = sound.FileSink(filename)
+			sound.play(encoder.to_morse(text), sink, renderer)
+			sink.close()
+			try:
+				decoded = ''.join(receive.decodeFile(filename))
+			finally:
+				os.remove(filename)
+			if text == ROUND_TRIP:
+				assert decoded == text, '{name}: {text!r} decoded as {decoded!r}'.format(name=name, text=text, decoded=decoded)
+			else:
+				assert decoded.replace(' ', '') == expected.replace(' ', ''), '{name}: {text!r} decoded as {decoded!r}'.format(name=name, text=text, decoded=decoded)
+
+# Decoding a recording of the sample bank's output, reported as how many
+# times faster than real time it runs
+def benchReceive(messages=200):
+	import receive
+	checkRoundTrip()
+	encoder = morse.CompiledMorseCode(strict_mode=False)
+	filename = tempfile.NamedTemporaryFile(suffix='.wav').name
+	sink = sound.FileSink(filename)
+	for seed in range(messages):
+		sound.play(encoder.to_morse(corpus(60, seed)), sink)
+	sink.close()
+	try:
+		seconds = sum(len(samples) / float(framerate) for (framerate, samples) in receive.readBlocks(filename))
+		elapsed = timed(lambda: list(receive.decodeFile(filename)))
+	finally:
+		os.remove(filename)
+	return [{'audioSeconds': seconds, 'seconds': elapsed, 'realtimeFactor': seconds / elapsed}]
+
+# Stands in for a plugin, writing lines as fast as it can, or at an
+# interval while noting when each was written
+PLUGIN = r'''
+import os, sys, time
+interval = float(os.environ['BENCH_INTERVAL'])
+times = open(os.environ['BENCH_TIMES'], 'w') if os.environ.get('BENCH_TIMES') else None
+for i in range(int(os.environ['BENCH_LINES'])):
+	if interval:
+		time.sleep(interval)
+	sys.stdout.write('M%d\n' % i)
+	sys.stdout.flush()
+	if times:
+		times.write('%r\n' % time.time())
+		times.flush()
+'''
+
+def syntheticPlugin(directory, name):
+	filename = os.path.join(directory, name + '.py')
+	with open(filename, 'w') as f:
+		f.write(PLUGIN)
+	plugin = types.ModuleType(name)
+	plugin.__file__ = filename
+	plugin.configured = lambda env: True
+	return plugin
+
+# Lines per second read by the dispatcher from several plugin processes
+# writing as fast as they can, including the time to start them
+def benchIntake(counts=(1, 4, 16), lines=5000):
+	import dispatch
+	import service
+	directory = tempfile.mkdtemp()
+	try:
+		plugin = syntheticPlugin(directory, 'intake')
+		env = dict(os.environ, BENCH_LINES=str(lines), BENCH_INTERVAL='0')
+		results = []
+		for count in counts:
+			dispatcher = dispatch.Dispatcher()
+			received = [0]
+			def onOutput(pluginName, line):
+				received[0] += 1
+			start = time.time()
+			processes = [service.runPlugin('plugin{i}'.format(i=i), plugin, env, dispatcher, onOutput, lambda pluginName, line: None) for i in range(count)]
+			while received[0] < count * lines:
+				dispatcher.runOnce()
+			elapsed = time.time() - start
+			for process in processes:
+				process.wait()
+			results.append({'plugins': count, 'lines': count * lines, 'seconds': elapsed, 'linesPerSecond': count * lines / elapsed})
+		return results
+	finally:
+		shutil.rmtree(directory)
+
+def percentile(values, fraction):
+	values = sorted(values)
+	return values[min(len(values) - 1, int(fraction * len(values)))]
+
+def summarize(latencies):
+	return {
+		'messages': len(latencies),
+		'p50': percentile(latencies, 0.5),
+		'p95': percentile(latencies, 0.95),
+		'max': max(latencies),
+	}
+
+# Notes when each message's first audio arrives
+class TimingSink(object):
+	streams = True
+
+	def __init__(self, expected, onDone):
+		self.times = []
+		self.expected = expected
+		self.onDone = onDone
+
+	def write(self, params, frames):
+		self.times.append(time.time())
+		if len(self.times) == self.expected:
+			self.onDone()
+
+	def close(self):
+		pass
+
+# Seconds from a plugin writing a line to its audio reaching the sink,
+# through the whole service with its default settings.  Each message is a
+# single word, so it reaches the sink in a single write.
+def benchLatency(messages=50, interval=0.02):
+	import service
+	directory = tempfile.mkdtemp()
+	saved = (service.CONFIG_PATH, service.VALIDATIONS_PATH, service.SECRET_PATH, service.plugins, sound._sink, sys.stdout, sys.stderr, signal.getsignal(signal.SIGINT), signal.getsignal(signal.SIGTERM))
+	try:
+		timesPath = os.path.join(directory, 'times')
+		os.environ.update(BENCH_LINES=str(messages), BENCH_INTERVAL=str(interval), BENCH_TIMES=timesPath)
+		with open(os.path.join(directory, 'config.ini'), 'w') as f:
+			f.write('[general]\nquiet = true\n')
+		service.CONFIG_PATH = os.path.join(directory, 'config.ini')
+		service.VALIDATIONS_PATH = os.path.join(directory, 'validated.json')
+		service.SECRET_PATH = os.path.join(directory, 'secret')
+		service.plugins = types.ModuleType('plugins')
+		service.plugins.latency = syntheticPlugin(directory, 'latency')
+		sound._sink = TimingSink(messages, lambda: os.kill(os.getpid(), signal.SIGTERM))
+		sys.stdout = sys.stderr = open(os.devnull, 'w')
+		service.service()
+		(sys.stdout, sys.stderr) = saved[5:7]
+		with open(timesPath) as f:
+			written = [float(line) for line in f]
+		return [dict(summarize([played - wrote for (wrote, played) in zip(written, sound._sink.times)]), sink='null')]
+	finally:
+		(service.CONFIG_PATH, service.VALIDATIONS_PATH, service.SECRET_PATH, service.plugins, sound._sink, sys.stdout, sys.stderr) = saved[:7]
+		signal.signal(signal.SIGINT, saved[7])
+		signal.signal(signal.SIGTERM, saved[8])
+		for name in ('BENCH_LINES', 'BENCH_INTERVAL', 'BENCH_TIMES'):
+			os.environ.pop(name, None)
+		shutil.rmtree(directory)
+
+# Seconds from a message arriving at a local fakeimap server to the
+# imap_email plugin announcing it, with IDLE and with polling
+def benchImap(messages=20):
+	import fakeimap
+	from plugins import imap_email
+	server = fakeimap.Server().start()
+	directory = tempfile.mkdtemp()
+	(checkpointDir, imap_email.CHECKPOINT_DIR) = (imap_email.CHECKPOINT_DIR, directory)
+	try:
+		results = []
+		for (mode, idle) in (('idle', True), ('poll', False)):
+			folder = mode.upper()
+			env = dict((imap_email.PREFIX + k, json.dumps(v)) for (k, v) in {
+				'HOST': '127.0.0.1',
+				'PORT': server.port,
+				'SSL': False,
+				'USERNAME': 'bench',
+				'PASSWORD': 'bench',
+				'IDLE': idle,
+				'POLL_MIN': 0.1,
+				'POLL_MAX': 0.1,
+				'FOLDERS': [folder],
+			}.iteritems())
+			announced = Queue.Queue()
+			stop = threading.Event()
+			def run(env=env, announced=announced, stop=stop):
+				for text in imap_email.messages(env):
+					if stop.is_set():
+						return
+					announced.put((text, time.time()))
+			thread = threading.Thread(target=run)
+			thread.daemon = True
+			thread.start()
+			# Messages from before the plugin connects are not announced
+			while True:
+				server.store.add('warmup', folder)
+				try:
+					announced.get(timeout=0.5)
+					break
+				except Queue.Empty:
+					pass
+			while not announced.empty():
+				announced.get()
+			latencies = []
+			for i in range(messages):
+				start = time.time()
+				server.store.add('message {i}'.format(i=i), folder)
+				(_, end) = announced.get(timeout=30)
+				latencies.append(end - start)
+			results.append(dict(summarize(latencies), mode=mode))
+			# One more message lets the plugin see it should stop
+			stop.set()
+			server.store.add('stop', folder)
+			thread.join()
+		return results
+	finally:
+		imap_email.CHECKPOINT_DIR = checkpointDir
+		server.shutdown()
+		shutil.rmtree(directory)
+
+BENCHMARKS = {
+	'decode': benchDecode,
+	'encode': benchEncode,
+	'imap': benchImap,
+	'intake': benchIntake,
+	'latency': benchLatency,
+	'receive': benchReceive,
+	'render': benchRender,
+	'sink': benchSink,
+}
+
+def main(arguments=None):
+	parser = argparse.ArgumentParser(description='Benchmark the stages of the service.')
+	parser.add_argument('names', nargs='*', metavar='benchmark', help='any of: ' + ', '.join(sorted(BENCHMARKS)))
+	parser.add_argument('--json', metavar='FILE', help='also write the results to FILE as JSON, or to stdout if FILE is -')
+	options = parser.parse_args(arguments)
+	unknown = [name for name in options.names if name not in BENCHMARKS]
+	if unknown:
+		parser.error('unknown benchmark: ' + ', '.join(unknown))
+
+	report = {
+		'python': platform.python_version(),
+		'platform': platform.platform(),
+		'time': time.time(),
+		'results': {},
+	}
+	for name in (options.names or sorted(BENCHMARKS)):
+		results = report['results'][name] = BENCHMARKS[name]()
+		if options.json != '-':
+			for result in results:
+				print name, ' '.join('{k}={v}'.format(k=k, v=v) for (k, v) in sorted(result.iteritems()))
+	if options.json == '-':
+		json.dump(report, sys.stdout, indent=2, sort_keys=True)
+		print
+	elif options.json:
+		with open(options.json, 'w') as f:
+			json.dump(report, f, indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,151 @@
+import collections
+import hashlib
+import json
+import mmap
+import os
+import os.path
+
+import sound
+
+CACHE_DIR = os.path.expanduser('~/.morsecowbell/cache')
+
+# Finished audio for recently played messages, so a subject which repeats
+# is not rendered again.  Entries are keyed by the morse code, which is
+# already normalised for case and by the downconverter, together with the
+# renderer's key(), so a change of speed, tone or samples misses rather than
+# playing stale audio.  The memory tier is an LRU bounded by the total size
+# of the frames.  The optional disk tier keeps one file per entry, also
+# bounded in bytes and evicted oldest first, and hands back frames mapped
+# with mmap rather than read into memory.
+class RenderCache(object):
+	def __init__(self, maxBytes=16 * 1024 * 1024, directory=None, maxDiskBytes=256 * 1024 * 1024):
+		self.maxBytes = maxBytes
+		self.directory = directory
+		self.maxDiskBytes = maxDiskBytes
+		self.bytes = 0
+		self.hits = 0
+		self.diskHits = 0
+		self.misses = 0
+		self.evictions = 0
+		self._entries = collections.OrderedDict()
+		self._files = collections.OrderedDict()
+		self.diskBytes = 0
+		if directory is not None:
+			self._scan()
+
+	def stats(self):
+		return {
+			'entries': len(self._entries),
+			'bytes': self.bytes,
+			'hits': self.hits,
+			'diskHits': self.diskHits,
+			'misses': self.misses,
+			'evictions': self.evictions,
+		}
+
+	def _scan(self):
+		if not os.path.exists(self.directory):
+			os.makedirs(self.directory)
+		files = []
+		for name in os.listdir(self.directory):
+			if name.endswith('.pcm'):
+				st = os.stat(os.path.join(self.directory, name))
+				files.append((st.st_mtime, name, st.st_size))
+		for (_, name, size) in sorted(files):
+			self._files[name] = size
+			self.diskBytes += size
+
+	def _insert(self, key, entry):
+		self._entries[key] = entry
+		self.bytes += len(entry[1])
+		while self.bytes > self.maxBytes and len(self._entries) > 1:
+			(_, (_, frames)) = self._entries.popitem(last=False)
+			self.bytes -= len(frames)
+			self.evictions += 1
+
+	def _filename(self, key):
+		return hashlib.sha1(json.dumps(key)).hexdigest() + '.pcm'
+
+	# Files hold a line of JSON params followed by the raw frames
+	def _load(self, name):
+		if name not in self._files:
+			return None
+		path = os.path.join(self.directory, name)
+		try:
+			with open(path, 'rb') as f:
+				mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+			offset = mapped.find(b'\n') + 1
+			if not offset:
+				raise ValueError('no header')
+			params = tuple(json.loads(mapped[:offset]))
+		except (IOError, OSError, ValueError, TypeError):
+			# A damaged entry is removed and treated as a miss
+			self.diskBytes -= self._files.pop(name)
+			try:
+				os.remove(path)
+			except OSError:
+				pass
+			return None
+		self._files[name] = self._files.pop(name)
+		return (params, buffer(mapped, offset))
+
+	def _store(self, name, params, frames):
+		path = os.path.join(self.directory, name)
+		with open(path + '.tmp', 'wb') as f:
+			f.write(json.dumps(params) + '\n')
+			f.write(frames)
+		os.rename(path + '.tmp', path)
+		size = os.path.getsize(path)
+		self.diskBytes += size - self._files.pop(name, 0)
+		self._files[name] = size
+		while self.diskBytes > self.maxDiskBytes and len(self._files) > 1:
+			(oldest, oldSize) = self._files.popitem(last=False)
+			self.diskBytes -= oldSize
+			try:
+				os.remove(os.path.join(self.directory, oldest))
+			except OSError:
+				pass
+
+	def _lookup(self, key):
+		entry = self._entries.pop(key, None)
+		if entry is not None:
+			self.hits += 1
+			self._entries[key] = entry
+			return entry
+		if self.directory is not None:
+			entry = self._load(self._filename(key))
+			if entry is not None:
+				self.diskHits += 1
+				self._insert(key, entry)
+				return entry
+		self.misses += 1
+		return None
+
+	def _add(self, key, entry):
+		self._insert(key, entry)
+		if self.directory is not None:
+			self._store(self._filename(key), entry[0], entry[1])
+
+	def render(self, renderer, morseCode):
+		key = (morseCode, renderer.key())
+		entry = self._lookup(key)
+		if entry is None:
+			entry = renderer.render(morseCode)
+			self._add(key, entry)
+		return entry
+
+	# Like sound.renderChunks, but a hit comes back as a single chunk and a
+	# miss is stored once its last word has been rendered
+	def chunks(self, renderer, morseCode):
+		key = (morseCode, renderer.key())
+		entry = self._lookup(key)
+		if entry is not None:
+			yield entry
+			return
+		chunks = []
+		for chunk in sound.renderChunks(renderer, morseCode):
+			chunks.append(chunk)
+			yield chunk
+		entry = sound.joinChunks(chunks)
+		if entry[0] is not None:
+			self._add(key, entry)
@@ -0,0 +1,63 @@
+import collections
+import re
+import time
+
+# Reply and forward markers at the start of a subject, however many deep:
+# "Re: Fwd: RE[2]: report"
+SUBJECT_PREFIX = re.compile(r'^(?:\s*(?:re|fwd?|aw|sv)\s*(?:\[\d+\])?\s*:)+\s*', re.I | re.U)
+NUMBER = re.compile(r'\d+(?:[.,:]\d+)*', re.U)
+SPACE = re.compile(r'\s+', re.U)
+
+# Collapses repeated messages from a plugin.  A message which matches one
+# still waiting to be played is folded into it, and the waiting message
+# gains a count suffix instead of a second transmission being queued.  Once
+# a message has played, the next repeat starts a new one, which then counts
+# the repeats after it.  Matches are remembered for ttl seconds after the
+# last repeat; the index is an OrderedDict in expiry order, so expiring
+# entries and touching one are both constant time.
+class Coalescer(object):
+	def __init__(self, ttl=300, foldNumbers=False, foldPrefixes=False):
+		self.ttl = ttl
+		self.foldNumbers = foldNumbers
+		self.foldPrefixes = foldPrefixes
+		self.merged = 0
+		self._index = collections.OrderedDict()
+
+	def __len__(self):
+		return len(self._index)
+
+	def key(self, source, text):
+		if self.foldPrefixes:
+			text = SUBJECT_PREFIX.sub(u'', text)
+		if self.foldNumbers:
+			text = NUMBER.sub(u'#', text)
+		return (source, SPACE.sub(u' ', text).strip().lower())
+
+	def _expire(self, now):
+		while self._index:
+			(key, (message, count, expires)) = next(self._index.iteritems())
+			if expires > now:
+				break
+			del self._index[key]
+
+	# Folds a repeat into the waiting message it matches, returning that
+	# message and its new text; returns (None, None) if there is no match
+	def merge(self, source, text):
+		now = time.time()
+		self._expire(now)
+		key = self.key(source, text)
+		entry = self._index.get(key)
+		if entry is None or not entry[0].queued:
+			return (None, None)
+		(message, count, _) = entry
+		count += 1
+		self.merged += 1
+		del self._index[key]
+		self._index[key] = (message, count, now + self.ttl)
+		return (message, u'{text} x{count}'.format(text=text, count=count))
+
+	# Remembers a newly queued message so later repeats can merge into it
+	def add(self, source, text, message):
+		key = self.key(source, text)
+		self._index.pop(key, None)
+		self._index[key] = (message, 1, time.time() + self.ttl)
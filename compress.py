@@ -0,0 +1,185 @@
+import re
+
+import coalesce
+import morse
+
+# Standard CW abbreviations, Q codes and prosigns.  Replacements in angle
+# brackets are prosigns, whose letters are sent run together without the
+# gaps between characters.
+ABBREVIATIONS = {
+	'ABOUT': 'ABT',
+	'AFTERNOON': 'AFTN',
+	'AGAIN': 'AGN',
+	'AND': 'ES',
+	'ARE': 'R',
+	'BECAUSE': 'BC',
+	'BEFORE': 'B4',
+	'BUSY': 'QRL',
+	'COPY': 'CPY',
+	'END OF MESSAGE': '<AR>',
+	'END OF WORK': '<SK>',
+	'ERROR': '<HH>',
+	'EVENING': 'EVE',
+	'FOR': 'FR',
+	'FREQUENCY': 'QRG',
+	'FROM': 'FM',
+	'GOOD': 'GD',
+	'GOOD AFTERNOON': 'GA',
+	'GOOD EVENING': 'GE',
+	'GOOD MORNING': 'GM',
+	'GOOD NIGHT': 'GN',
+	'HAVE': 'HV',
+	'HERE': 'HR',
+	'INTERFERENCE': 'QRM',
+	'LOCATION': 'QTH',
+	'MESSAGE': 'MSG',
+	'MESSAGES': 'MSGS',
+	'MORNING': 'MRNG',
+	'NOISE': 'QRN',
+	'NUMBER': 'NR',
+	'OLD MAN': 'OM',
+	'OVER': 'K',
+	'PLEASE': 'PSE',
+	'POWER': 'PWR',
+	'RECEIVE': 'RX',
+	'RECEIVED': 'RCVD',
+	'REPORT': 'RPT',
+	'SIGNAL': 'SIG',
+	'THANK YOU': 'TU',
+	'THANKS': 'TNX',
+	'THE': 'T',
+	'THIS': 'DIS',
+	'TODAY': 'TDY',
+	'TOMORROW': 'TMW',
+	'TONIGHT': 'TNITE',
+	'TRANSMIT': 'TX',
+	'UNDERSTOOD': '<SN>',
+	'WAIT': '<AS>',
+	'WEATHER': 'WX',
+	'WILL': 'WL',
+	'WITH': 'W',
+	'WORD': 'WD',
+	'WORDS': 'WDS',
+	'WOULD': 'WUD',
+	'YOU': 'U',
+	'YOUR': 'UR',
+}
+
+# Cut numbers: the digits sent as the shorter letters conventionally read
+# as digits in number groups
+CUT_NUMBERS = {
+	'0': 'T',
+	'1': 'A',
+	'2': 'U',
+	'3': 'V',
+	'5': 'E',
+	'7': 'B',
+	'8': 'D',
+	'9': 'N',
+}
+
+PUNCTUATION = '.,;:!?"\'()'
+PROSIGN = re.compile(r'^<([A-Z0-9]+)>$')
+DIGITS = re.compile(r'^[0-9]+$')
+
+# Rewrites messages to take less air time before they are encoded.  Each
+# abbreviation is kept only if, by morse.units(), it is actually shorter
+# than what it replaces.  Phrases are matched a word at a time against a
+# trie of the dictionary, taking the longest match at each word, so the
+# work is linear in the length of the message.  Reply and forward prefixes
+# can be dropped, and all-digit words sent as cut numbers.
+class Compressor(object):
+	def __init__(self, code, abbreviations=ABBREVIATIONS, stripPrefixes=True, cutNumbers=False):
+		# code is the MorseCode instance in use, whose to_morse may have been
+		# replaced to downconvert unicode
+		self.code = code
+		self.encode = code.to_morse
+		self.stripPrefixes = stripPrefixes
+		self.cutNumbers = cutNumbers
+		self.saved = 0
+		self.messages = 0
+		self._trie = {}
+		for (phrase, replacement) in abbreviations.iteritems():
+			if replacement is None:
+				continue
+			words = phrase.upper().split()
+			replacement = self._render(replacement.upper())
+			saving = morse.units(self.encode(' '.join(words))) - morse.units(replacement)
+			if words and saving > 0:
+				node = self._trie
+				for word in words:
+					node = node.setdefault(word, {})
+				node[None] = (len(words), replacement, saving)
+		# Cut numbers are costed the same way, and keyed as single letters
+		# even where pymorse's entry for the letter has stray spaces
+		self._cuts = {}
+		for (digit, letter) in CUT_NUMBERS.iteritems():
+			cut = self.code.CHAR_TO_MORSE[letter].replace(' ', '')
+			saving = morse.units(self.encode(digit)) - morse.units(cut)
+			if saving > 0:
+				self._cuts[digit] = (cut, saving)
+
+	def _render(self, replacement):
+		match = PROSIGN.match(replacement)
+		if match:
+			return ''.join(self.code.CHAR_TO_MORSE[char].replace(' ', '') for char in match.group(1))
+		return self.encode(replacement)
+
+	def _longest(self, cores, start):
+		node = self._trie
+		found = None
+		for i in xrange(start, len(cores)):
+			node = node.get(cores[i])
+			if node is None:
+				break
+			found = node.get(None, found)
+		return found
+
+	# Returns the morse code for text and the units saved by compressing it
+	def compress(self, text):
+		saved = 0
+		if self.stripPrefixes:
+			stripped = coalesce.SUBJECT_PREFIX.sub(u'', text)
+			if stripped != text:
+				saved += morse.units(self.encode(text[:len(text) - len(stripped)]))
+				text = stripped
+		words = text.upper().split()
+		cores = [word.strip(PUNCTUATION) for word in words]
+		codes = []
+		# Words without an abbreviation are encoded together
+		plain = []
+		i = 0
+		while i < len(words):
+			found = self._longest(cores, i)
+			if found is None:
+				word = words[i]
+				if self.cutNumbers and DIGITS.match(word) and any(digit in self._cuts for digit in word):
+					if plain:
+						codes.append(self.encode(u' '.join(plain)))
+						plain = []
+					codes.append(self.code.char_sep.join(self._cuts[digit][0] if digit in self._cuts else self.encode(digit) for digit in word))
+					saved += sum(self._cuts[digit][1] for digit in word if digit in self._cuts)
+				else:
+					plain.append(word)
+				i += 1
+				continue
+			if plain:
+				codes.append(self.encode(u' '.join(plain)))
+				plain = []
+			(length, replacement, saving) = found
+			# Keep any punctuation around the phrase
+			(first, last) = (words[i], words[i + length - 1])
+			lead = first[:len(first) - len(first.lstrip(PUNCTUATION))]
+			trail = last[len(last.rstrip(PUNCTUATION)):]
+			parts = [self.encode(lead)] if lead else []
+			parts.append(replacement)
+			if trail:
+				parts.append(self.encode(trail))
+			codes.append(self.code.char_sep.join(parts))
+			saved += saving
+			i += length
+		if plain:
+			codes.append(self.encode(u' '.join(plain)))
+		self.saved += saved
+		self.messages += 1
+		return (self.code.word_sep.join(codes), saved)
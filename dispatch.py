@@ -0,0 +1,141 @@
+import collections
+import errno
+import fcntl
+import heapq
+import itertools
+import os
+import select
+import signal
+import time
+
+# A single-threaded event loop which sleeps in select() until there is
+# something to do: a readable file descriptor, a due timer, or a callback
+# posted from another thread or a signal handler.
+class Dispatcher(object):
+	def __init__(self):
+		self._readers = {}
+		self._timers = []
+		self._sequence = itertools.count()
+		self._pending = collections.deque()
+		(self._wakeRead, self._wakeWrite) = os.pipe()
+		for fd in (self._wakeRead, self._wakeWrite):
+			flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+			fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+		self.running = False
+
+	def addReader(self, fd, callback, *args):
+		self._readers[fd] = (callback, args)
+
+	def removeReader(self, fd):
+		self._readers.pop(fd, None)
+
+	def callLater(self, delay, callback, *args):
+		timer = [time.time() + delay, next(self._sequence), callback, args]
+		heapq.heappush(self._timers, timer)
+		return timer
+
+	def cancel(self, timer):
+		# Lazily removed when it reaches the top of the heap
+		timer[2] = None
+
+	# Safe to call from other threads and from signal handlers
+	def callSoon(self, callback, *args):
+		self._pending.append((callback, args))
+		try:
+			os.write(self._wakeWrite, b'\0')
+		except OSError as e:
+			if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+				raise
+
+	def stop(self):
+		self.running = False
+		self.callSoon(lambda: None)
+
+	def stopOnSignals(self, signums=(signal.SIGINT, signal.SIGTERM)):
+		for signum in signums:
+			signal.signal(signum, lambda signum, frame: self.stop())
+
+	def _timeout(self):
+		if self._pending:
+			return 0
+		while self._timers and self._timers[0][2] is None:
+			heapq.heappop(self._timers)
+		if not self._timers:
+			return None
+		return max(0, self._timers[0][0] - time.time())
+
+	def _drainWakeups(self):
+		try:
+			while os.read(self._wakeRead, 4096):
+				pass
+		except OSError as e:
+			if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+				raise
+
+	def runOnce(self):
+		try:
+			(readable, _, _) = select.select([self._wakeRead] + list(self._readers), [], [], self._timeout())
+		except (select.error, OSError) as e:
+			if e.args[0] != errno.EINTR:
+				raise
+			readable = []
+
+		for fd in readable:
+			if fd == self._wakeRead:
+				self._drainWakeups()
+			elif fd in self._readers:
+				(callback, args) = self._readers[fd]
+				callback(*args)
+
+		now = time.time()
+		while self._timers and (self._timers[0][2] is None or self._timers[0][0] <= now):
+			(_, _, callback, args) = heapq.heappop(self._timers)
+			if callback is not None:
+				callback(*args)
+
+		# Only run what was posted before this pass, so a callback which
+		# re-posts itself cannot starve the file descriptors and timers
+		for _ in range(len(self._pending)):
+			(callback, args) = self._pending.popleft()
+			callback(*args)
+
+	def run(self):
+		self.running = True
+		while self.running:
+			self.runOnce()
+
+# Reads a pipe without blocking and hands complete lines to a callback.
+# Partial lines are held until the rest arrives or the pipe closes.
+class LineReader(object):
+	def __init__(self, dispatcher, stream, callback, *args):
+		self.dispatcher = dispatcher
+		self.stream = stream
+		self.fd = stream.fileno()
+		self.callback = callback
+		self.args = args
+		self._partial = b''
+		flags = fcntl.fcntl(self.fd, fcntl.F_GETFL)
+		fcntl.fcntl(self.fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+		dispatcher.addReader(self.fd, self._onReadable)
+
+	def _onReadable(self):
+		try:
+			data = os.read(self.fd, 65536)
+		except OSError as e:
+			if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+				return
+			raise
+		if not data:
+			self.close()
+			return
+		lines = (self._partial + data).split(b'\n')
+		self._partial = lines.pop()
+		for line in lines:
+			self.callback(*(self.args + (line,)))
+
+	def close(self):
+		self.dispatcher.removeReader(self.fd)
+		if self._partial:
+			self.callback(*(self.args + (self._partial,)))
+			self._partial = b''
+		self.stream.close()
@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+
+# A small in-memory IMAP server for exercising the imap_email plugin without
+# a real mail account.  It understands just enough IMAP4rev1 for imaplib and
+# the plugin: LOGIN, SELECT/EXAMINE, STATUS, NOOP, UID SEARCH, UID FETCH,
+# IDLE, CLOSE and LOGOUT.  Any username and password are accepted.
+#
+#     python fakeimap.py [port]
+#
+# Each line typed on stdin is delivered to INBOX as the subject of a new
+# message.
+
+import email.utils
+import imaplib
+import re
+import select
+import socket
+import SocketServer
+import sys
+import threading
+import time
+
+class Store(object):
+	def __init__(self, uidValidity=None, idle=True):
+		self.uidValidity = uidValidity or int(time.time())
+		self.idle = idle
+		self.folders = {}
+		self.condition = threading.Condition()
+
+	def folder(self, name):
+		return self.folders.setdefault(name.upper() if name.upper() == 'INBOX' else name, [])
+
+	def add(self, subject, folder='INBOX', body='', sender='sender@example.com'):
+		with self.condition:
+			messages = self.folder(folder)
+			uid = (messages[-1][0] if messages else 0) + 1
+			message = 'From: {sender}\r\nSubject: {subject}\r\nDate: {date}\r\n\r\n{body}\r\n'.format(sender=sender, subject=subject, date=email.utils.formatdate(), body=body)
+			messages.append((uid, message))
+			self.condition.notify_all()
+			return uid
+
+# Splits a possibly quoted mailbox name off the front of the arguments
+def splitName(arguments):
+	match = re.match(r'\s*("(?:[^"\\]|\\.)*"|\S+)\s*(.*)$', arguments)
+	(name, rest) = match.groups()
+	if name.startswith('"'):
+		name = re.sub(r'\\(.)', r'\1', name[1:-1])
+	return (name, rest)
+
+def parseSet(text, messages):
+	last = messages[-1][0] if messages else 0
+	uids = set()
+	for part in text.split(','):
+		(low, _, high) = part.partition(':')
+		low = last if low == '*' else int(low)
+		high = low if not high else (last if high == '*' else int(high))
+		(low, high) = (min(low, high), max(low, high))
+		uids.update(uid for (uid, _) in messages if low <= uid <= high)
+	return uids
+
+def headerFields(message, fields):
+	(headers, _, _) = message.partition('\r\n\r\n')
+	lines = []
+	keep = False
+	for line in headers.split('\r\n'):
+		if line[:1] not in (' ', '\t'):
+			keep = line.split(':', 1)[0].upper() in fields
+		if keep:
+			lines.append(line)
+	return '\r\n'.join(lines) + '\r\n\r\n'
+
+class Handler(SocketServer.StreamRequestHandler):
+	def send(self, line):
+		self.wfile.write(line + '\r\n')
+		self.wfile.flush()
+
+	def setup(self):
+		SocketServer.StreamRequestHandler.setup(self)
+		self.server.connections.add(self.connection)
+
+	def finish(self):
+		self.server.connections.discard(self.connection)
+		try:
+			SocketServer.StreamRequestHandler.finish(self)
+		except socket.error:
+			pass
+
+	def handle(self):
+		self.store = self.server.store
+		self.selected = None
+		self.reported = 0
+		self.send('* OK fakeimap ready')
+		while True:
+			line = self.rfile.readline()
+			if not line:
+				return
+			(tag, _, rest) = line.strip().partition(' ')
+			(command, _, arguments) = rest.partition(' ')
+			command = command.upper()
+			if command == 'UID':
+				(command, _, arguments) = arguments.partition(' ')
+				command = 'UID ' + command.upper()
+			method = getattr(self, 'do_' + command.replace(' ', '_'), None)
+			if method is None:
+				self.send(tag + ' BAD unknown command')
+				continue
+			if method(tag, arguments) is False:
+				return
+
+	def capabilities(self):
+		return 'IMAP4rev1' + (' IDLE' if self.store.idle else '')
+
+	def do_CAPABILITY(self, tag, arguments):
+		self.send('* CAPABILITY ' + self.capabilities())
+		self.send(tag + ' OK CAPABILITY completed')
+
+	def do_LOGIN(self, tag, arguments):
+		self.send(tag + ' OK [CAPABILITY ' + self.capabilities() + '] LOGIN completed')
+
+	def do_SELECT(self, tag, arguments):
+		with self.store.condition:
+			(self.selected, _) = splitName(arguments)
+			messages = self.store.folder(self.selected)
+			self.reported = len(messages)
+			self.send('* FLAGS (\\Seen)')
+			self.send('* {count} EXISTS'.format(count=len(messages)))
+			self.send('* 0 RECENT')
+			self.send('* OK [UIDVALIDITY {v}] UIDs valid'.format(v=self.store.uidValidity))
+			self.send('* OK [UIDNEXT {n}] Predicted next UID'.format(n=(messages[-1][0] if messages else 0) + 1))
+		self.send(tag + ' OK [READ-ONLY] SELECT completed')
+	do_EXAMINE = do_SELECT
+
+	def do_STATUS(self, tag, arguments):
+		(name, items) = splitName(arguments)
+		with self.store.condition:
+			messages = self.store.folder(name)
+			values = {
+				'MESSAGES': len(messages),
+				'UIDNEXT': (messages[-1][0] if messages else 0) + 1,
+				'UIDVALIDITY': self.store.uidValidity,
+				'RECENT': 0,
+				'UNSEEN': 0,
+			}
+		requested = items.strip('()').upper().split()
+		self.send('* STATUS "{name}" ({items})'.format(name=name, items=' '.join('{k} {v}'.format(k=k, v=values[k]) for k in requested)))
+		self.send(tag + ' OK STATUS completed')
+
+	def reportExists(self):
+		messages = self.store.folder(self.selected)
+		if len(messages) != self.reported:
+			self.reported = len(messages)
+			self.send('* {count} EXISTS'.format(count=len(messages)))
+
+	def do_NOOP(self, tag, arguments):
+		if self.selected is not None:
+			with self.store.condition:
+				self.reportExists()
+		self.send(tag + ' OK NOOP completed')
+
+	def do_UID_SEARCH(self, tag, arguments):
+		with self.store.condition:
+			messages = self.store.folder(self.selected)
+			match = re.search(r'UID (\S+)', arguments, re.I)
+			uids = parseSet(match.group(1).rstrip(')'), messages) if match else set(uid for (uid, _) in messages)
+		self.send('* SEARCH' + ''.join(' ' + str(uid) for uid in sorted(uids)))
+		self.send(tag + ' OK SEARCH completed')
+
+	def do_UID_FETCH(self, tag, arguments):
+		(uidSet, _, items) = arguments.partition(' ')
+		with self.store.condition:
+			messages = self.store.folder(self.selected)
+			uids = parseSet(uidSet, messages)
+			selected = [(i + 1, uid, message) for (i, (uid, message)) in enumerate(messages) if uid in uids]
+		headers = re.search(r'BODY\.PEEK\[HEADER\.FIELDS \(([^)]*)\)\]', items, re.I)
+		internalDate = re.search(r'\bINTERNALDATE\b', items, re.I)
+		for (sequence, uid, message) in selected:
+			attributes = 'UID {uid}'.format(uid=uid)
+			if internalDate:
+				# The time the message was added, from its Date header
+				date = re.search(r'^Date: (.*)$', message, re.M).group(1).strip()
+				attributes += ' INTERNALDATE ' + imaplib.Time2Internaldate(email.utils.mktime_tz(email.utils.parsedate_tz(date)))
+			if headers:
+				fields = headers.group(1).upper().split()
+				data = headerFields(message, fields)
+				name = 'BODY[HEADER.FIELDS ({fields})]'.format(fields=' '.join(fields))
+			else:
+				data = message
+				name = 'RFC822'
+			self.wfile.write('* {sequence} FETCH ({attributes} {name} {{{size}}}\r\n{data})\r\n'.format(sequence=sequence, attributes=attributes, name=name, size=len(data), data=data))
+		self.send(tag + ' OK FETCH completed')
+
+	def do_IDLE(self, tag, arguments):
+		self.send('+ idling')
+		while True:
+			with self.store.condition:
+				self.reportExists()
+			# Buffered input counts as readable too
+			if self.rfile._rbuf.tell() or select.select([self.connection], [], [], 0.05)[0]:
+				line = self.rfile.readline()
+				if not line:
+					return False
+				if line.strip().upper() == 'DONE':
+					self.send(tag + ' OK IDLE terminated')
+					return
+				self.send(tag + ' BAD expected DONE')
+				return
+
+	def do_CLOSE(self, tag, arguments):
+		self.selected = None
+		self.send(tag + ' OK CLOSE completed')
+
+	def do_LOGOUT(self, tag, arguments):
+		self.send('* BYE logging out')
+		self.send(tag + ' OK LOGOUT completed')
+		return False
+
+class Server(SocketServer.ThreadingTCPServer):
+	daemon_threads = True
+	allow_reuse_address = True
+
+	def __init__(self, address=('127.0.0.1', 0), store=None):
+		SocketServer.ThreadingTCPServer.__init__(self, address, Handler)
+		self.store = store or Store()
+		self.connections = set()
+
+	@property
+	def port(self):
+		return self.server_address[1]
+
+	# Drops every client, as a server restart or network failure would
+	def disconnectAll(self):
+		for connection in list(self.connections):
+			try:
+				connection.shutdown(socket.SHUT_RDWR)
+			except socket.error:
+				pass
+
+	def start(self):
+		thread = threading.Thread(target=self.serve_forever)
+		thread.daemon = True
+		thread.start()
+		return self
+
+if __name__ == '__main__':
+	server = Server(('127.0.0.1', int(sys.argv[1]) if len(sys.argv) > 1 else 1143)).start()
+	print >> sys.stderr, 'fakeimap listening on port', server.port
+	for line in iter(sys.stdin.readline, ''):
+		server.store.add(line.strip())
@@ -0,0 +1,63 @@
+import math
+
+import numpy
+
+import synth
+
+# One stream of messages with its own tone and position in the stereo field.
+# pan runs from -1 (left) to 1 (right) and uses a constant-power law, so a
+# voice sounds equally loud wherever it is placed.
+class Voice(object):
+	def __init__(self, frequency=700, pan=0.0):
+		self.frequency = frequency
+		self.pan = pan
+		angle = (pan + 1) * math.pi / 4
+		self.gains = numpy.array([math.cos(angle), math.sin(angle)])
+		self._samples = None
+		self._offset = 0
+
+	@property
+	def busy(self):
+		return self._samples is not None
+
+	# template supplies the speed and the rest of the synthesis parameters,
+	# so a SpeedGovernor acting on it applies to every voice
+	def synthesizer(self, template):
+		return synth.Synthesizer(template.wpm, template.farnsworth, self.frequency, template.sampleRate, template.rampMs, template.amplitude)
+
+	# frames are mono 16-bit audio, as rendered by synthesizer()
+	def start(self, frames):
+		self._samples = numpy.frombuffer(frames, dtype='<i2')
+		self._offset = 0
+
+	def take(self, nframes):
+		block = numpy.zeros(nframes)
+		if self._samples is not None:
+			piece = self._samples[self._offset:self._offset + nframes]
+			block[:len(piece)] = piece
+			self._offset += len(piece)
+			if self._offset >= len(self._samples):
+				(self._samples, self._offset) = (None, 0)
+		return block
+
+# Sums several voices into one stereo stream, a block at a time, so messages
+# from different sources can be keyed over each other and followed by ear
+# much as a listener picks out stations on a crowded band.  Each voice is
+# scaled by one over the number of voices, so the sum cannot clip and the
+# level stays the same as voices start and stop.
+class Mixer(object):
+	def __init__(self, sampleRate=8000, blockSeconds=0.25):
+		self.sampleRate = sampleRate
+		self.blockFrames = int(sampleRate * blockSeconds)
+		self.voices = {}
+
+	def mix(self):
+		busy = [voice for voice in self.voices.itervalues() if voice.busy]
+		if not busy:
+			return None
+		mono = numpy.array([voice.take(self.blockFrames) for voice in busy])
+		gains = numpy.array([voice.gains for voice in busy])
+		# (voices, frames) by (voices, channels) gives (frames, channels)
+		stereo = mono.T.dot(gains) / len(self.voices)
+		frames = stereo.astype('<i2').tostring()
+		return ((2, 2, self.sampleRate, self.blockFrames, 'NONE', 'not compressed'), frames)
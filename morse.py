@@ -0,0 +1,170 @@
+import collections
+import os.path
+import re
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(__file__), 'thirdparty'))
+import pymorse
+
+# Attributes which the compiled tables depend on
+COMPILED_ATTRIBUTES = ('char_sep', 'word_sep', 'missing_char_placeholder')
+
+# A run of symbols or a run of anything else
+TOKENS = re.compile(r'[.-]+|[^.-]+')
+
+class _InvalidCharacter(Exception):
+	pass
+
+# A drop-in MorseCode whose to_morse output is identical to pymorse's, but
+# which validates the separators and builds its lookup table only when one
+# of COMPILED_ATTRIBUTES changes rather than on every call.  Characters
+# which cannot be encoded are tallied in invalidCharacters instead of being
+# logged.
+class CompiledMorseCode(pymorse.MorseCode):
+	def __init__(self, strict_mode=True):
+		self.invalidCharacters = collections.Counter()
+		self._table = None
+		pymorse.MorseCode.__init__(self, strict_mode)
+
+	def __setattr__(self, name, value):
+		if name in COMPILED_ATTRIBUTES:
+			self.__dict__['_table'] = None
+		object.__setattr__(self, name, value)
+
+	def _compile(self):
+		self._check_separators()
+		self._table = dict((char, code) for (char, code) in self.CHAR_TO_MORSE.iteritems() if len(char) == 1)
+		return self._table
+
+	def _missing(self, char):
+		if self.strict_mode:
+			raise _InvalidCharacter(char)
+		self.invalidCharacters[char] += 1
+		return self.missing_char_placeholder
+
+	def _encode(self, text, get):
+		charSep = self.char_sep
+		words = []
+		for word in text.upper().split():
+			codes = map(get, word)
+			if None in codes:
+				codes = [code if code is not None else self._missing(char) for (char, code) in zip(word, codes)]
+			words.append(charSep.join(codes))
+		return self.word_sep.join(words)
+
+	def to_morse(self, text):
+		get = (self._table or self._compile()).get
+		try:
+			return self._encode(text, get)
+		except _InvalidCharacter:
+			# Let pymorse raise its usual error
+			return pymorse.MorseCode.to_morse(self, text)
+
+	def to_morse_many(self, texts):
+		get = (self._table or self._compile()).get
+		try:
+			return [self._encode(text, get) for text in texts]
+		except _InvalidCharacter:
+			return [pymorse.MorseCode.to_morse(self, text) for text in texts]
+
+# Length of a to_morse string in dit units, counting the gap after each
+# element and each separator space as one unit apiece, so that "PARIS "
+# comes to the standard 50 units
+def units(morseCode):
+	return 2 * morseCode.count('.') + 4 * morseCode.count('-') + 2 * morseCode.count(' ')
+
+# Builds an implicit binary trie from a table of morse sequences.  The root
+# is node 0 and the dit and dah children of node n are 2n+1 and 2n+2, so the
+# node for a sequence of length d whose dits and dahs spell the binary
+# number v (dit being 0) is 2**d - 1 + v.  A few of pymorse's sequences
+# (B, C and 8) contain stray spaces, which are ignored here.
+def buildTrie(morseToChar):
+	codes = dict((code.replace(' ', ''), char) for (code, char) in morseToChar.iteritems())
+	codes = dict((code, char) for (code, char) in codes.iteritems() if code and not code.strip('.-'))
+	nodes = [None] * (2 ** (max(len(code) for code in codes) + 1) - 1)
+	for (code, char) in codes.iteritems():
+		nodes[2 ** len(code) - 1 + int(code.replace('.', '0').replace('-', '1'), 2)] = char
+	return nodes
+
+# Decodes morse code incrementally.  feed() accepts any number of symbols
+# and returns the characters completed by them, so arbitrarily long input
+# can be decoded in constant memory.  A character is emitted as soon as the
+# gap after it starts, and a word gap is emitted as a single space before
+# the next character.  Separators and placeholders come from the MorseCode
+# instance given, whose from_morse this matches on well-formed input.
+class StreamDecoder(object):
+	def __init__(self, code=None):
+		self.code = code or pymorse.MorseCode()
+		self.code._check_separators()
+		self._gapCharacters = set(self.code.char_sep + self.code.word_sep)
+		self._nodes = buildTrie(self.code.MORSE_TO_CHAR)
+		self._maxDepth = len(bin(len(self._nodes))) - 3
+		# Trie lookups memoized by sequence; bounded by the size of the trie
+		self._chars = {}
+		self.reset()
+
+	def reset(self):
+		self._symbols = ''
+		self._gap = ''
+		self._space = False
+		self._started = False
+
+	def _walk(self, symbols):
+		if len(symbols) > self._maxDepth:
+			return None
+		char = self._chars.get(symbols)
+		if char is None:
+			char = self._nodes[2 ** len(symbols) - 1 + int(symbols.replace('.', '0').replace('-', '1'), 2)]
+			if char is not None:
+				self._chars[symbols] = char
+		return char
+
+	def _close(self):
+		char = self._walk(self._symbols)
+		if char is None:
+			if self.code.strict_mode:
+				raise pymorse.MorseCodeError('Illegal morse code sequence', 'Morse code contains a non-valid code sequence')
+			char = self.code.missing_morse_code_placeholder
+		if self._space:
+			char = ' ' + char
+		self._symbols = ''
+		self._space = False
+		self._started = True
+		return char
+
+	def feed(self, symbols):
+		decoded = []
+		charSep = self.code.char_sep
+		wordSep = self.code.word_sep
+		for token in TOKENS.findall(symbols):
+			if token[0] in '.-':
+				# Sequences too long for the trie are kept just long enough
+				# to be recognised as invalid
+				self._symbols = (self._symbols + token)[:self._maxDepth + 1]
+				self._gap = ''
+				continue
+			if token != charSep and token != wordSep and not self._gapCharacters.issuperset(token):
+				raise pymorse.MorseCodeError('Morse Code error', 'Morse code contains invalid characters')
+			if self._symbols:
+				decoded.append(self._close())
+			self._gap = (self._gap + token)[-len(wordSep):]
+			if self._started and self._gap.endswith(wordSep):
+				self._space = True
+		return ''.join(decoded)
+
+	def close(self):
+		decoded = ''
+		if self._symbols:
+			decoded = self._close()
+		self.reset()
+		return decoded
+
+def decodeStream(chunks, code=None):
+	decoder = StreamDecoder(code)
+	for chunk in chunks:
+		decoded = decoder.feed(chunk)
+		if decoded:
+			yield decoded
+	decoded = decoder.close()
+	if decoded:
+		yield decoded
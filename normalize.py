@@ -0,0 +1,105 @@
+import collections
+import unicodedata
+try:
+	import unidecode
+except ImportError:
+	unidecode = None
+
+# Blocks whose characters are translated up front, covering the Latin,
+# Greek and Cyrillic alphabets and typographic punctuation.  Characters
+# outside them are translated when first seen.
+BLOCKS = [
+	(0x0000, 0x0250),
+	(0x0370, 0x0500),
+	(0x1E00, 0x1F00),
+	(0x2000, 0x2070),
+]
+
+# Latin letters which do not decompose into a base letter and an accent
+LETTERS = {
+	u'\xc6': u'AE',
+	u'\xd0': u'D',
+	u'\xd8': u'O',
+	u'\xde': u'TH',
+	u'\xdf': u'SS',
+	u'\xe6': u'AE',
+	u'\xf0': u'D',
+	u'\xf8': u'O',
+	u'\xfe': u'TH',
+	u'\u0110': u'D',
+	u'\u0111': u'D',
+	u'\u0131': u'I',
+	u'\u0141': u'L',
+	u'\u0142': u'L',
+	u'\u0152': u'OE',
+	u'\u0153': u'OE',
+	u'\u2013': u'-',
+	u'\u2014': u'--',
+	u'\u2018': u"'",
+	u'\u2019': u"'",
+	u'\u201c': u'"',
+	u'\u201d': u'"',
+	u'\u2026': u'...',
+}
+
+# The nearest basic Latin, in capitals, for a single character.  unidecode
+# is used when it is installed; otherwise accents are stripped by
+# decomposing the character, and whatever is left outside ASCII is kept for
+# the encoder to replace with its placeholder.
+def transliterate(char):
+	if unidecode is not None:
+		return unicode(unidecode.unidecode(char)).upper()
+	if char in LETTERS:
+		return LETTERS[char]
+	decomposed = u''.join(c for c in unicodedata.normalize('NFKD', char) if not unicodedata.combining(c))
+	try:
+		return unicode(decomposed.encode('ascii')).upper()
+	except UnicodeEncodeError:
+		return char.upper()
+
+# Folds case and strips accents, or transliterates other scripts, in a
+# single unicode.translate pass over a plain dict, which translate reads
+# several times faster than a dict subclass with __missing__.  The table is
+# built once for the precomputed blocks.  Characters outside them come
+# through the pass untranslated, and so outside ASCII; they are then
+# transliterated, added to the table and the text translated again.  Up to
+# memoSize such characters are kept after each message, and as translate
+# gives no sign of which are still in use, those added longest ago go
+# first.  The result encodes the same as unidecode.unidecode(text), for a
+# fraction of the cost per message.
+class Normalizer(object):
+	def __init__(self, memoSize=1024):
+		self.memoSize = memoSize
+		self.table = {}
+		for (start, end) in BLOCKS:
+			for codePoint in xrange(start, end):
+				self.table[codePoint] = transliterate(unichr(codePoint))
+		self.memo = collections.deque()
+
+	# Returns an ASCII str when everything could be translated, which the
+	# encoder looks up faster than unicode, otherwise unicode
+	def normalize(self, text):
+		# Most messages are plain ASCII already
+		try:
+			return text.encode('ascii').upper()
+		except UnicodeEncodeError:
+			pass
+		translated = text.translate(self.table)
+		try:
+			return translated.encode('ascii')
+		except UnicodeEncodeError:
+			pass
+		missing = set(ord(char) for char in translated if char >= u'\x80' and ord(char) not in self.table)
+		if not missing:
+			# Only characters which are kept as they are, without unidecode
+			return translated
+		for codePoint in missing:
+			self.table[codePoint] = transliterate(unichr(codePoint))
+			self.memo.append(codePoint)
+		translated = text.translate(self.table)
+		while len(self.memo) > self.memoSize:
+			del self.table[self.memo.popleft()]
+		try:
+			return translated.encode('ascii')
+		except UnicodeEncodeError:
+			return translated
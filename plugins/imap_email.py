@@ -1,14 +1,54 @@
-import email
+import email.errors
+import email.header
+import email.utils
 import getpass
 import imaplib
 import json
 import os
 import os.path
+import re
+import select
+import socket
+import ssl
 import sys
+import threading
 import time
 import traceback
 
 PREFIX = os.path.splitext(os.path.basename(__file__))[0].upper() + '_'
+
+# Servers may drop an IDLE connection after 30 minutes (RFC 2177)
+IDLE_TIMEOUT = 25 * 60
+# Polling interval bounds, in seconds, for servers without IDLE
+POLL_MIN = 2
+POLL_MAX = 60
+# Reconnection delay bounds, in seconds, after a connection fails
+RECONNECT_MIN = 1
+RECONNECT_MAX = 300
+# Connections opened to check the configuration are logged out if serve()
+# has not claimed them within this many seconds
+CLAIM_TIMEOUT = 60
+# Seconds to wait on a server before giving up on the connection, so one
+# which stops answering cannot hold up the other folders being watched
+SOCKET_TIMEOUT = 60
+# Set in the environment by a host which will run messages() in the same
+# process as configured(), so the connection can be kept for it
+INPROCESS = 'MORSECOWBELL_INPROCESS'
+
+# How each message is announced; {subject} and {sender} are available
+FORMAT = u'{subject}'
+
+# Where the last announced UID is remembered between runs
+CHECKPOINT_DIR = os.path.expanduser('~/.morsecowbell')
+# At most this many messages that arrived while the plugin was not running
+# are announced on startup
+CATCHUP = 20
+
+EXISTS = re.compile(r'\* \d+ EXISTS', re.I)
+FETCH_SEQUENCE = re.compile(r'^(\d+) ')
+FETCH_UID = re.compile(r'\bUID (\d+)', re.I)
+STATUS_ITEM = re.compile(r'(UIDNEXT|UIDVALIDITY) (\d+)', re.I)
+FOLDED = re.compile(r'\r?\n[ \t]+')
 def parseConfiguration(env):
 	return {k.split(PREFIX)[1]: json.loads(v) for (k, v) in env.iteritems() if k.startswith(PREFIX)}
 
@@ -64,46 +104,407 @@ def configure(env):
 
 	return {PREFIX + k: json.dumps(v) for (k, v) in ret.iteritems()}
 
+# imaplib's connections, opened with a timeout, which it does not support
+# itself before Python 3.9.  The server's greeting is read while the
+# connection is being made, so setting one afterwards would be too late.
+class TimeoutIMAP4(imaplib.IMAP4):
+	def __init__(self, host, port, timeout):
+		self.timeout = timeout
+		imaplib.IMAP4.__init__(self, host, port)
+
+	def open(self, host, port):
+		self.host = host
+		self.port = port
+		self.sock = socket.create_connection((host, port), self.timeout)
+		self.file = self.sock.makefile('rb')
+
+class TimeoutIMAP4_SSL(imaplib.IMAP4_SSL):
+	def __init__(self, host, port, timeout):
+		self.timeout = timeout
+		imaplib.IMAP4_SSL.__init__(self, host, port)
+
+	def open(self, host, port):
+		self.host = host
+		self.port = port
+		self.sock = socket.create_connection((host, port), self.timeout)
+		self.sslobj = ssl.wrap_socket(self.sock, self.keyfile, self.certfile)
+		self.file = self.sslobj.makefile('rb')
+
 def connection(config):
-	cls = (imaplib.IMAP4_SSL if config['SSL'] == True else imaplib.IMAP4)
-	mailbox = cls(config['HOST'], config['PORT'])
+	cls = (TimeoutIMAP4_SSL if config['SSL'] == True else TimeoutIMAP4)
+	mailbox = cls(config['HOST'], config['PORT'], config.get('SOCKET_TIMEOUT', SOCKET_TIMEOUT))
 	mailbox.login(config['USERNAME'], config['PASSWORD'])
-	mailbox.select(readonly=True)
 	return mailbox
 
+# Besides the account configured interactively, more can be listed in
+# ACCOUNTS; each is a dictionary of the same settings, and anything it
+# leaves out is taken from the main account.  FOLDERS lists the folders to
+# watch in each account.
+def accounts(config):
+	main = {k: v for (k, v) in config.iteritems() if k != 'ACCOUNTS'}
+	return [main] + [dict(main, **account) for account in config.get('ACCOUNTS', [])]
+
+def accountKey(account):
+	return (account['HOST'], account['PORT'], account['USERNAME'])
+
+def quote(folder):
+	return '"' + folder.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+# Logged-in connections left by configured() for serve() to pick up
+_validated = {}
+_validatedLock = threading.Lock()
+
+def _expire(key, mailbox):
+	with _validatedLock:
+		if _validated.get(key) is not mailbox:
+			return
+		del _validated[key]
+	try:
+		mailbox.logout()
+	except Exception:
+		pass
+
+def claim(account):
+	with _validatedLock:
+		return _validated.pop(accountKey(account), None)
+
+# When the plugin is to run in this process, the connections opened here
+# are kept for messages() to reuse; a subprocess could never claim them,
+# so otherwise they are logged out at once
 def configured(env):
 	config = parseConfiguration(env)
+	keep = env.get(INPROCESS) == '1'
 
 	try:
-		mailbox = connection(config)
-		mailbox.close()
-		mailbox.logout()
+		for account in accounts(config):
+			mailbox = connection(account)
+			if not keep:
+				mailbox.logout()
+				continue
+			key = accountKey(account)
+			with _validatedLock:
+				previous = _validated.get(key)
+				_validated[key] = mailbox
+			if previous is not None:
+				_expire(key, previous)
+			timer = threading.Timer(CLAIM_TIMEOUT, _expire, (key, mailbox))
+			timer.daemon = True
+			timer.start()
 		return True
-	except:
+	except Exception:
 		for line in traceback.format_exc().splitlines():
 			print >> sys.stderr, line
 		return False
 
-def serve():
-	config = parseConfiguration(os.environ)
-	mailbox = connection(config)
-	(result, data) = mailbox.uid('search', None, 'ALL')
-	latestUid = int(data[0].split()[-1])
+# imaplib reads through a buffered file object, and over SSL the socket has
+# a buffer of its own, so a response may be waiting even though select()
+# would block
+def buffered(mailbox):
+	rbuf = getattr(getattr(mailbox, 'file', None), '_rbuf', None)
+	if rbuf is not None and rbuf.tell():
+		return True
+	sslobj = getattr(mailbox, 'sslobj', None)
+	return sslobj is not None and sslobj.pending() > 0
+
+# IDLE, which imaplib does not support itself, split into its three steps
+# so that many connections can idle at once.  startIdle() returns the tag
+# to pass to finishIdle(); readIdle() consumes one line the server sent
+# meanwhile and returns True if it announced a new message.
+def startIdle(mailbox):
+	tag = mailbox._new_tag()
+	mailbox.send('{tag} IDLE\r\n'.format(tag=tag))
+	line = mailbox.readline()
+	if not line.startswith('+'):
+		mailbox.tagged_commands.pop(tag, None)
+		raise mailbox.error('IDLE refused: ' + line.strip())
+	return tag
+
+def readIdle(mailbox):
+	line = mailbox.readline()
+	if not line:
+		raise mailbox.abort('connection closed during IDLE')
+	return EXISTS.match(line) is not None
+
+def finishIdle(mailbox, tag):
+	try:
+		mailbox.send('DONE\r\n')
+		while True:
+			line = mailbox.readline()
+			if not line:
+				raise mailbox.abort('connection closed during IDLE')
+			if line.startswith(tag + ' '):
+				if line.split()[1].upper() != 'OK':
+					raise mailbox.error(line.strip())
+				return
+	finally:
+		mailbox.tagged_commands.pop(tag, None)
+
+def supportsIdle(mailbox):
+	(result, data) = mailbox.capability()
+	return 'IDLE' in data[0].upper().split()
+
+# Compresses UIDs into an IMAP sequence set such as 3:7,9
+def uidSet(uids):
+	ranges = []
+	for uid in sorted(uids):
+		if ranges and uid == ranges[-1][1] + 1:
+			ranges[-1][1] = uid
+		else:
+			ranges.append([uid, uid])
+	return ','.join(str(low) if low == high else '{low}:{high}'.format(low=low, high=high) for (low, high) in ranges)
+
+# Decodes RFC 2047 encoded words, leaving anything undecodable as it was
+def decodeHeader(value):
+	try:
+		return unicode(email.header.make_header(email.header.decode_header(value)))
+	except (email.errors.HeaderParseError, LookupError, UnicodeError):
+		return value.decode('utf-8', 'replace')
+
+def parseHeaders(text):
+	headers = {}
+	for line in FOLDED.sub(' ', text).splitlines():
+		(name, colon, value) = line.partition(':')
+		if colon:
+			headers.setdefault(name.strip().lower(), value.strip())
+	return headers
+
+# Fetches just the headers needed for the announcements of all the given
+# messages in one round-trip, without downloading bodies or attachments,
+# along with each one's UID and when it reached the server (None if the
+# server did not say).  Messages come back in mailbox order.
+def fetchHeaders(mailbox, uids):
+	(result, data) = mailbox.uid('fetch', uidSet(uids), '(INTERNALDATE BODY.PEEK[HEADER.FIELDS (SUBJECT FROM)])')
+	messages = []
+	for (i, item) in enumerate(data):
+		if isinstance(item, tuple):
+			# Servers may send attributes after the literal, which imaplib
+			# leaves in the next element
+			trailer = data[i + 1] if i + 1 < len(data) and isinstance(data[i + 1], str) else ''
+			attributes = item[0] + ' ' + trailer
+			sequence = FETCH_SEQUENCE.match(item[0])
+			uid = FETCH_UID.search(attributes)
+			arrived = imaplib.Internaldate2tuple(attributes)
+			messages.append((int(sequence.group(1)) if sequence else 0, int(uid.group(1)) if uid else None, parseHeaders(item[1]), time.mktime(arrived) if arrived else None))
+	return [message[1:] for message in sorted(messages)]
+
+def describe(headers, format):
+	(name, address) = email.utils.parseaddr(decodeHeader(headers.get('from', '')))
+	return format.format(subject=decodeHeader(headers.get('subject', '')), sender=name or address)
 
+# Each announcement is tagged with when the message reached the server and
+# when it was found, so the service can tell polling delays from its own
+def tag(text, arrived, found):
+	tags = u'ts={found:.3f}'.format(found=found)
+	if arrived is not None:
+		tags = u'origin={arrived:.0f};'.format(arrived=arrived) + tags
+	return u'\x01' + tags + u'\t' + text
+
+def check(mailbox, latestUid, format=FORMAT, limit=None):
+	(result, data) = mailbox.uid('search', None, '(UID {firstUid}:*)'.format(firstUid=str(latestUid + 1)))
+	uids = [int(uid) for uid in data[0].split() if int(uid) > latestUid]
+
+	# Only the newest messages are announced when a limit is given
+	announced = uids
+	if limit is not None:
+		announced = uids[-limit:] if limit else []
+	texts = []
+	if announced:
+		found = time.time()
+		for (uid, headers, arrived) in fetchHeaders(mailbox, announced):
+			text = describe(headers, format)
+			if text.strip():
+				texts.append(tag(text, arrived, found))
+
+	return (max(uids + [latestUid]), texts)
+
+# The mailbox's UIDVALIDITY and UIDNEXT, from the SELECT response if the
+# server included them there or else from a STATUS command.  Either is far
+# cheaper than searching the whole mailbox.
+def position(mailbox, folder='INBOX'):
+	values = {}
+	for name in ('UIDVALIDITY', 'UIDNEXT'):
+		(_, data) = mailbox.response(name)
+		if data and data[0] is not None:
+			values[name] = int(data[0])
+	if len(values) < 2:
+		(result, data) = mailbox.status(folder, '(UIDVALIDITY UIDNEXT)')
+		values.update((name.upper(), int(value)) for (name, value) in STATUS_ITEM.findall(data[0]))
+	return (values['UIDVALIDITY'], values['UIDNEXT'])
+
+def checkpointPath(config, folder='INBOX'):
+	name = '{username}@{host}-{folder}'.format(username=config['USERNAME'], host=config['HOST'], folder=folder)
+	return os.path.join(CHECKPOINT_DIR, 'imap_email-' + re.sub(r'[^\w@.-]', '_', name) + '.json')
+
+def loadCheckpoint(path):
+	try:
+		with open(path, 'rb') as f:
+			checkpoint = json.load(f)
+		return (checkpoint['uidvalidity'], checkpoint['uid'])
+	except (IOError, ValueError, KeyError):
+		return (None, None)
+
+def saveCheckpoint(path, uidValidity, uid):
+	if not os.path.exists(os.path.dirname(path)):
+		os.mkdir(os.path.dirname(path))
+	temporary = path + '.tmp'
+	with open(temporary, 'wb') as f:
+		json.dump({'uidvalidity': uidValidity, 'uid': uid}, f)
+	os.rename(temporary, path)
+
+# Watches one folder of one account over its own connection
+class Watcher(object):
+	def __init__(self, config, folder='INBOX', mailbox=None):
+		self.config = config
+		self.folder = folder
+		self.mailbox = None
+		self._reuse = mailbox
+		self.idleTag = None
+		self.deadline = 0
+		self.backoff = RECONNECT_MIN
+		self.format = config.get('FORMAT', FORMAT)
+		self.idleTimeout = config.get('IDLE_TIMEOUT', IDLE_TIMEOUT)
+		self.pollMin = config.get('POLL_MIN', POLL_MIN)
+		self.pollMax = config.get('POLL_MAX', POLL_MAX)
+
+	def __str__(self):
+		return '{username}@{host}/{folder}'.format(username=self.config['USERNAME'], host=self.config['HOST'], folder=self.folder)
+
+	def fileno(self):
+		return self.mailbox.socket().fileno()
+
+	def start(self):
+		(mailbox, self._reuse) = (self._reuse, None)
+		self.mailbox = mailbox or connection(self.config)
+		self.mailbox.select(quote(self.folder), readonly=True)
+
+		# Resume after the last announced message if the UIDs are still
+		# valid, otherwise start with whatever arrives next
+		(self.uidValidity, uidNext) = position(self.mailbox, quote(self.folder))
+		self.path = checkpointPath(self.config, self.folder)
+		(savedValidity, savedUid) = loadCheckpoint(self.path)
+		self.latestUid = uidNext - 1
+		catchup = 0
+		if savedValidity == self.uidValidity and savedUid < self.latestUid:
+			(self.latestUid, catchup) = (savedUid, self.config.get('CATCHUP', CATCHUP))
+		(self.latestUid, texts) = check(self.mailbox, self.latestUid, self.format, catchup)
+		saveCheckpoint(self.path, self.uidValidity, self.latestUid)
+
+		# Push notifications where the server offers them, otherwise poll,
+		# backing off while the folder is quiet
+		self.useIdle = self.config.get('IDLE', True) and supportsIdle(self.mailbox)
+		self.interval = self.pollMin
+		self.backoff = RECONNECT_MIN
+		self._wait()
+		return texts
+
+	def _check(self):
+		previousUid = self.latestUid
+		(self.latestUid, texts) = check(self.mailbox, self.latestUid, self.format)
+		if self.latestUid > previousUid:
+			saveCheckpoint(self.path, self.uidValidity, self.latestUid)
+		return texts
+
+	def _wait(self):
+		if self.useIdle:
+			self.idleTag = startIdle(self.mailbox)
+			self.deadline = time.time() + self.idleTimeout
+		else:
+			self.deadline = time.time() + self.interval
+
+	@property
+	def idling(self):
+		return self.idleTag is not None
+
+	def ready(self):
+		return self.idling and buffered(self.mailbox)
+
+	# These return the announcements for any new messages found
+
+	def onReadable(self):
+		texts = []
+		if readIdle(self.mailbox):
+			(tag, self.idleTag) = (self.idleTag, None)
+			finishIdle(self.mailbox, tag)
+			texts = self._check()
+			self._wait()
+		return texts
+
+	def onTimeout(self):
+		if self.mailbox is None:
+			return self.start()
+		if self.idling:
+			# Re-issue IDLE before the server gives up on it
+			(tag, self.idleTag) = (self.idleTag, None)
+			finishIdle(self.mailbox, tag)
+			texts = self._check()
+		else:
+			previousUid = self.latestUid
+			self.mailbox.noop()
+			texts = self._check()
+			self.interval = self.pollMin if self.latestUid > previousUid else min(2 * self.interval, self.pollMax)
+		self._wait()
+		return texts
+
+	def fail(self):
+		print >> sys.stderr, '{watcher}: reconnecting in {backoff}s'.format(watcher=self, backoff=self.backoff)
+		for line in traceback.format_exc().splitlines():
+			print >> sys.stderr, line
+		if self.mailbox is not None:
+			try:
+				self.mailbox.shutdown()
+			except Exception:
+				pass
+		(self.mailbox, self.idleTag) = (None, None)
+		self.deadline = time.time() + self.backoff
+		self.backoff = min(2 * self.backoff, RECONNECT_MAX)
+
+# Services every watcher from one thread, sleeping in select() until a
+# connection has something to say or a watcher's deadline comes up, and
+# yields the announcements as they are found.  Nothing is yielded inside the
+# try blocks, so closing the generator is not mistaken for a failure.
+def watch(watchers):
 	while True:
-		(result, data) = mailbox.uid('search', None, '(UID {latestUid}:*)'.format(latestUid=str(latestUid)))
-		uids = [int(uid) for uid in data[0].split() if int(uid) > latestUid]
-		
-		for uid in uids:
-			(result, data) = mailbox.uid('fetch', str(uid), '(RFC822)')
-			message = email.message_from_string(data[0][1])
-			print message['subject']
-			sys.stdout.flush()
-
-		latestUid = max(uids + [latestUid])
-		time.sleep(10)
-		# Refresh
-		mailbox.recent()
+		now = time.time()
+		for watcher in watchers:
+			if watcher.deadline <= now:
+				try:
+					texts = watcher.onTimeout()
+				except Exception:
+					watcher.fail()
+					continue
+				for text in texts:
+					yield text
+
+		ready = [watcher for watcher in watchers if watcher.ready()]
+		if not ready:
+			timeout = max(0, min(watcher.deadline for watcher in watchers) - time.time())
+			(ready, _, _) = select.select([watcher for watcher in watchers if watcher.idling], [], [], timeout)
+		for watcher in ready:
+			try:
+				texts = watcher.onReadable()
+			except Exception:
+				watcher.fail()
+				continue
+			for text in texts:
+				yield text
+
+# The plugin's messages, for running in the service's own process
+def messages(env):
+	config = parseConfiguration(env)
+	watchers = []
+	for account in accounts(config):
+		# The first folder of each account reuses the connection which
+		# validated it, if there is one
+		mailbox = claim(account)
+		for folder in account.get('FOLDERS', ['INBOX']):
+			watchers.append(Watcher(account, folder, mailbox))
+			mailbox = None
+	return watch(watchers)
+
+def serve():
+	for text in messages(os.environ):
+		print text.encode('utf-8')
+		sys.stdout.flush()
 
 if __name__ == '__main__':
 	serve()
@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+
+import collections
+import sys
+import wave
+
+import numpy
+
+import morse
+
+# Yields blocks of mono samples scaled to [-1, 1), so recordings of any
+# length are read in bounded memory
+def readBlocks(filename, blockSeconds=1.0):
+	waveRead = wave.open(filename, 'rb')
+	try:
+		(nchannels, sampwidth, framerate) = waveRead.getparams()[:3]
+		dtype = {1: 'u1', 2: '<i2', 4: '<i4'}[sampwidth]
+		scale = float(2 ** (8 * sampwidth - 1))
+		blockFrames = max(1, int(framerate * blockSeconds))
+		while True:
+			frames = waveRead.readframes(blockFrames)
+			if not frames:
+				break
+			samples = numpy.frombuffer(frames, dtype=dtype).astype(numpy.float64)
+			if sampwidth == 1:
+				samples -= 128
+			samples = samples.reshape(-1, nchannels).mean(axis=1) / scale
+			yield (framerate, samples)
+	finally:
+		waveRead.close()
+
+def estimateFrequency(framerate, samples):
+	spectrum = numpy.abs(numpy.fft.rfft(samples * numpy.hanning(len(samples))))
+	spectrum[0] = 0
+	return numpy.argmax(spectrum) * float(framerate) / len(samples)
+
+# Splits audio into short windows and measures the power at the tone
+# frequency in each, which is a Goertzel filter evaluated for every window
+# at once.  Windows are classified as keyed or not against a threshold that
+# follows the signal and noise levels, and the result is reported as runs of
+# (keyed, seconds).  Samples left over at the end of a block are carried
+# into the next one.
+class ToneDetector(object):
+	def __init__(self, frequency=None, windowSeconds=0.005, decay=0.9):
+		self.frequency = frequency
+		self.windowSeconds = windowSeconds
+		self.decay = decay
+		self._framerate = None
+		self._carry = numpy.zeros(0)
+		self._peak = 0.0
+		self._floor = None
+		self._keyed = False
+		self._run = 0
+
+	def _setup(self, framerate, samples):
+		self._framerate = framerate
+		self._window = max(1, int(round(framerate * self.windowSeconds)))
+		if self.frequency is None:
+			self.frequency = estimateFrequency(framerate, samples)
+		n = numpy.arange(self._window)
+		self._kernel = numpy.exp(-2j * numpy.pi * self.frequency * n / framerate)
+
+	def feed(self, framerate, samples):
+		if self._framerate is None:
+			if not numpy.any(samples):
+				# Leading silence; wait for some signal to find the frequency
+				return []
+			self._setup(framerate, samples)
+		samples = numpy.concatenate([self._carry, samples])
+		windows = len(samples) // self._window
+		self._carry = samples[windows * self._window:]
+		if not windows:
+			return []
+		power = numpy.abs(samples[:windows * self._window].reshape(windows, self._window).dot(self._kernel)) ** 2
+
+		# Track the tone and noise levels; the threshold sits between them
+		self._peak = max(self._peak * self.decay, power.max())
+		quiet = numpy.percentile(power, 10)
+		self._floor = quiet if self._floor is None else min(max(self._floor, quiet * self.decay), quiet / self.decay)
+		threshold = self._floor + 0.25 * (self._peak - self._floor)
+		keyed = power > threshold
+
+		# Collapse the keyed windows into runs
+		changes = numpy.flatnonzero(keyed[1:] != keyed[:-1]) + 1
+		runs = []
+		start = 0
+		for change in list(changes) + [windows]:
+			state = bool(keyed[start])
+			if state == self._keyed:
+				self._run += change - start
+			else:
+				if self._run:
+					runs.append((self._keyed, self._run * self._window / float(self._framerate)))
+				(self._keyed, self._run) = (state, change - start)
+			start = change
+		return runs
+
+	def close(self):
+		runs = []
+		if self._run and self._framerate is not None:
+			runs.append((self._keyed, self._run * self._window / float(self._framerate)))
+		self._run = 0
+		return runs
+
+# Turns keyed runs into the dits, dahs and separators of a MorseCode
+# instance.  The length of a dit is learnt as it goes, so the speed of the
+# sender does not need to be known in advance.  The character gap is taken
+# from the lower third of recent gaps, since most gaps are between
+# characters, and anything well beyond it is a word gap; this also copes with Farnsworth
+# spacing, where the gaps are stretched relative to the dits.
+#
+# The first few elements are held back until there are enough of them to
+# tell dits from dahs, so the start of a transmission is not garbled while
+# the estimates settle.
+class Symbolizer(object):
+	def __init__(self, code=None, wpm=20, smoothing=0.2, history=31, calibration=12):
+		self.code = code or morse.CompiledMorseCode()
+		self.unit = 1.2 / wpm
+		self.smoothing = smoothing
+		self.calibration = calibration
+		self._gaps = collections.deque(maxlen=history)
+		self._held = []
+
+	@property
+	def wpm(self):
+		return 1.2 / self.unit
+
+	@property
+	def charGap(self):
+		if len(self._gaps) < 3:
+			return 3 * self.unit
+		return sorted(self._gaps)[len(self._gaps) // 3]
+
+	def _learn(self, unit):
+		self.unit += self.smoothing * (unit - self.unit)
+
+	def _calibrate(self):
+		marks = sorted(seconds for (keyed, seconds) in self._held if keyed)
+		# Dahs are three times as long as dits; look for the widest step
+		(ratio, split) = max((marks[i + 1] / marks[i], i + 1) for i in range(len(marks) - 1))
+		if ratio > 1.8:
+			dits = marks[:split]
+			self.unit = dits[len(dits) // 2]
+		# Silence before the first element says nothing about the spacing
+		first = next(i for (i, (keyed, seconds)) in enumerate(self._held) if keyed)
+		self._gaps.extend(seconds for (keyed, seconds) in self._held[first:] if not keyed and seconds >= 2 * self.unit)
+
+	def _symbols(self, runs):
+		symbols = []
+		for (keyed, seconds) in runs:
+			if keyed:
+				if seconds < 0.3 * self.unit:
+					# Too short to be a deliberate element
+					continue
+				if seconds < 2 * self.unit:
+					symbols.append('.')
+					self._learn(seconds)
+				else:
+					symbols.append('-')
+					self._learn(seconds / 3)
+			elif seconds >= 2 * self.unit:
+				# Word gaps are 7/3 of character gaps; split the difference
+				if seconds >= self.charGap * 5 / 3:
+					symbols.append(self.code.word_sep)
+				else:
+					symbols.append(self.code.char_sep)
+				self._gaps.append(seconds)
+		return ''.join(symbols)
+
+	def feed(self, runs):
+		if self._held is None:
+			return self._symbols(runs)
+		self._held.extend(runs)
+		if sum(1 for (keyed, seconds) in self._held if keyed) < self.calibration:
+			return ''
+		return self.close()
+
+	def close(self):
+		if not self._held:
+			self._held = None
+			return ''
+		if sum(1 for (keyed, seconds) in self._held if keyed) > 1:
+			self._calibrate()
+		(runs, self._held) = (self._held, None)
+		return self._symbols(runs)
+
+# Decodes a WAV recording of morse code, yielding text as it is recognised
+def decodeFile(filename, frequency=None, wpm=20, code=None):
+	code = code or morse.CompiledMorseCode(strict_mode=False)
+	detector = ToneDetector(frequency)
+	symbolizer = Symbolizer(code, wpm)
+	decoder = morse.StreamDecoder(code)
+	for (framerate, samples) in readBlocks(filename):
+		text = decoder.feed(symbolizer.feed(detector.feed(framerate, samples)))
+		if text:
+			yield text
+	text = decoder.feed(symbolizer.feed(detector.close()) + symbolizer.close() + code.char_sep) + decoder.close()
+	if text:
+		yield text
+
+if __name__ == '__main__':
+	for filename in sys.argv[1:]:
+		for text in decodeFile(filename):
+			sys.stdout.write(text)
+			sys.stdout.flush()
+		print
@@ -0,0 +1,145 @@
+import heapq
+import itertools
+import time
+
+# A plugin may start a line with \x01, then key=value pairs separated by
+# semicolons, then a tab, to set the priority of that message (higher plays
+# first) or its deadline (seconds it may wait before it is dropped).  For
+# the stage timings in stats.py it may also give, in seconds since the
+# epoch, when it wrote the line (ts) and when the event it reports happened
+# (origin):
+#
+#     \x01priority=5;deadline=120\tServer down
+#     \x01origin=1500000000;ts=1500000002.25\tNew mail
+TAG_START = u'\x01'
+TAGS = {
+	'priority': int,
+	'deadline': float,
+	'origin': float,
+	'ts': float,
+}
+
+# Returns (tags, text); unknown or malformed tags are ignored
+def parseTags(line):
+	if not line.startswith(TAG_START) or u'\t' not in line:
+		return ({}, line)
+	(header, _, text) = line[len(TAG_START):].partition(u'\t')
+	tags = {}
+	for item in header.split(u';'):
+		(key, _, value) = item.partition(u'=')
+		key = key.strip().lower()
+		if key in TAGS:
+			try:
+				tags[str(key)] = TAGS[key](value)
+			except ValueError:
+				pass
+	return (tags, text)
+
+# Sits between plugin intake and playback.  Messages play highest priority
+# first, and in arrival order within a priority.  The backlog is bounded by
+# air time rather than by count: when it would exceed backlog seconds the
+# lowest priority, oldest messages are shed, and messages still waiting at
+# their deadline are shed too.  Every operation is O(log n); the three heaps
+# drop entries for messages that have left the queue lazily, and are
+# rebuilt once such stale entries outnumber the live ones.
+class Message(object):
+	def __init__(self, text, morseCode, units, source=None, priority=0, deadline=None, origin=None):
+		self.text = text
+		self.morseCode = morseCode
+		self.units = units
+		self.source = source
+		self.priority = priority
+		self.deadline = deadline
+		self.received = time.time()
+		# The earliest time known for the message, for its total latency
+		self.origin = origin or self.received
+		self.queued = False
+
+class Scheduler(object):
+	def __init__(self, unitSeconds, backlog=600, maxAge=3600, summarize=True):
+		# unitSeconds returns the current length of a dit in seconds
+		self.unitSeconds = unitSeconds
+		self.backlog = backlog
+		self.maxAge = maxAge
+		self.summarize = summarize
+		self.units = 0
+		self.queued = 0
+		self.shed = {}
+		self._unreported = 0
+		self._sequence = itertools.count()
+		self._order = []
+		self._victims = []
+		self._deadlines = []
+
+	def __len__(self):
+		return self.queued
+
+	def backlogSeconds(self):
+		return self.units * self.unitSeconds()
+
+	def _shed(self, message, reason):
+		message.queued = False
+		self.queued -= 1
+		self.units -= message.units
+		key = (message.source, reason)
+		self.shed[key] = self.shed.get(key, 0) + 1
+		self._unreported += 1
+
+	# Each heap keeps a message until it is popped from that heap, so played
+	# messages linger in the other two; all three are rebuilt once the
+	# largest holds twice as many entries as there are messages waiting
+	def _compact(self):
+		if max(len(self._order), len(self._victims), len(self._deadlines)) > 2 * self.queued + 64:
+			for heap in (self._order, self._victims, self._deadlines):
+				heap[:] = [entry for entry in heap if entry[-1].queued]
+				heapq.heapify(heap)
+
+	def push(self, message):
+		now = time.time()
+		if message.deadline is None:
+			message.deadline = now + self.maxAge
+		sequence = next(self._sequence)
+		message.queued = True
+		self.queued += 1
+		self.units += message.units
+		heapq.heappush(self._order, (-message.priority, sequence, message))
+		heapq.heappush(self._victims, (message.priority, sequence, message))
+		heapq.heappush(self._deadlines, (message.deadline, sequence, message))
+
+		limit = self.backlog / self.unitSeconds()
+		while self.queued and self.units > limit:
+			(_, _, victim) = heapq.heappop(self._victims)
+			if victim.queued:
+				self._shed(victim, 'backlog')
+		self._compact()
+
+	# Replaces the contents of a message which may still be waiting
+	def update(self, message, text, morseCode, units):
+		if message.queued:
+			self.units += units - message.units
+		(message.text, message.morseCode, message.units) = (text, morseCode, units)
+
+	def _expire(self, now):
+		while self._deadlines and self._deadlines[0][0] <= now:
+			(_, _, message) = heapq.heappop(self._deadlines)
+			if message.queued:
+				self._shed(message, 'deadline')
+		self._compact()
+
+	# Returns the next message to play, or None.  If anything was shed since
+	# the last call, a short summary message comes first.
+	def pop(self):
+		self._expire(time.time())
+		if self._unreported and self.summarize:
+			(count, self._unreported) = (self._unreported, 0)
+			return Message('{count} dropped'.format(count=count), None, 0, source='scheduler')
+		self._unreported = 0
+		while self._order:
+			(_, _, message) = heapq.heappop(self._order)
+			if message.queued:
+				message.queued = False
+				self.queued -= 1
+				self.units -= message.units
+				self._compact()
+				return message
+		return None
@@ -1,44 +1,141 @@
 #!/usr/bin/env python
 
 import ConfigParser
+import hashlib
+import hmac
 import json
 import os.path
-import Queue
 import subprocess
 import sys
 import threading
 import time
+import traceback
+
+import cache
+import coalesce
+import compress
+import dispatch
 try:
-	import unidecode
+	import mixer
 except ImportError:
-	class FakeUnidecode(object):
-		def unidecode(text):
-			return text
-	unidecode = FakeUnidecode()
-
+	mixer = None
+import morse
+import normalize
 import plugins
+import scheduler
 import sound
-
-sys.path.append(os.path.join(os.path.dirname(__file__), 'thirdparty'))
-import pymorse
+import stats
+try:
+	import synth
+except ImportError:
+	synth = None
 
 CONFIG_PATH = os.path.expanduser('~/.morsecowbell/config.ini')
+# When each plugin's configuration last passed its check
+VALIDATIONS_PATH = os.path.expanduser('~/.morsecowbell/validated.json')
+# A random key for the digests in VALIDATIONS_PATH, created on first run, so
+# they cannot be used to guess the passwords in the configuration
+SECRET_PATH = os.path.expanduser('~/.morsecowbell/secret')
+# Successful checks are trusted for this long, in seconds, while the
+# plugin's configuration stays the same
+VALIDATION_TTL = 24 * 60 * 60
+# Seconds to wait for a plugin's configuration check before starting it anyway
+CHECK_TIMEOUT = 30
+
+# Delay bounds, in seconds, before restarting an in-process plugin which
+# raised an exception
+RESTART_MIN = 1
+RESTART_MAX = 300
+
+# Both pipes of every plugin are multiplexed onto the dispatcher, so there
+# are no reader threads and each line arrives tagged with its plugin name
+def runPlugin(pluginName, plugin, env, dispatcher, onOutput, onError):
+	p = subprocess.Popen('python ' + plugin.__file__, stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=('posix' in sys.builtin_module_names), env=env, shell=True)
+	dispatch.LineReader(dispatcher, p.stdout, onOutput, pluginName)
+	dispatch.LineReader(dispatcher, p.stderr, onError, pluginName)
+	return p
+
+# Runs a plugin's messages(env) generator on its own thread in this process,
+# which avoids an interpreter per plugin.  A plugin that raises has its
+# traceback reported like stderr output and is restarted after a delay;
+# the other plugins carry on regardless.  Untrusted plugins should stay in
+# their own processes.
+def runPluginInProcess(pluginName, plugin, env, dispatcher, onOutput, onError):
+	def run():
+		delay = RESTART_MIN
+		while True:
+			try:
+				for text in plugin.messages(env):
+					dispatcher.callSoon(onOutput, pluginName, text)
+					delay = RESTART_MIN
+				dispatcher.callSoon(onError, pluginName, 'finished')
+				return
+			except Exception:
+				for line in traceback.format_exc().splitlines():
+					dispatcher.callSoon(onError, pluginName, line)
+				dispatcher.callSoon(onError, pluginName, 'restarting in {delay}s'.format(delay=delay))
+				time.sleep(delay)
+				delay = min(2 * delay, RESTART_MAX)
+	thread = threading.Thread(target=run, name=pluginName)
+	thread.daemon = True
+	thread.start()
+	return thread
+
+# Calls plugin.configured(env) on its own thread and later, on the
+# dispatcher, callback(result).  The result is None if the check did not
+# finish within timeout seconds.
+def checkPlugin(plugin, env, dispatcher, callback, timeout=CHECK_TIMEOUT):
+	state = {'done': False}
+	def finish(result):
+		if not state['done']:
+			state['done'] = True
+			dispatcher.cancel(timer)
+			callback(result)
+	def check():
+		try:
+			result = bool(plugin.configured(env))
+		except Exception:
+			traceback.print_exc()
+			result = False
+		dispatcher.callSoon(finish, result)
+	timer = dispatcher.callLater(timeout, finish, None)
+	thread = threading.Thread(target=check)
+	thread.daemon = True
+	thread.start()
+
+def loadSecret():
+	try:
+		with open(SECRET_PATH, 'rb') as f:
+			return f.read()
+	except IOError:
+		pass
+	if not os.path.exists(os.path.dirname(SECRET_PATH)):
+		os.mkdir(os.path.dirname(SECRET_PATH))
+	secret = os.urandom(32)
+	fd = os.open(SECRET_PATH + '.tmp', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+	with os.fdopen(fd, 'wb') as f:
+		f.write(secret)
+	os.rename(SECRET_PATH + '.tmp', SECRET_PATH)
+	return secret
+
+# Keyed with the install's secret, as the section includes passwords
+def configurationDigest(config, pluginName, secret):
+	items = sorted(config.items(pluginName)) if config.has_section(pluginName) else []
+	return hmac.new(secret, json.dumps(items), hashlib.sha256).hexdigest()
 
-# With thanks to http://stackoverflow.com/questions/375427/non-blocking-read-on-a-subprocess-pipe-in-python
-def enqueueOutput(outputStream, outputQueue):
-	for line in iter(outputStream.readline, b''):
-		print line
-		outputQueue.put(line)
-	outputStream.close()
-
-def runPlugin(plugin, env, stdoutQueue, stderrQueue):
-	p = subprocess.Popen('python ' + plugin.__file__, stdout=subprocess.PIPE, stderr=subprocess.PIPE, bufsize=1, close_fds=('posix' in sys.builtin_module_names), env=env, shell=True)
-	stdoutThread = threading.Thread(target=enqueueOutput, args=(p.stdout, stdoutQueue))
-	stdoutThread.daemon = True
-	stdoutThread.start()
-	stderrThread = threading.Thread(target=enqueueOutput, args=(p.stderr, stderrQueue))
-	stderrThread.daemon = True
-	stderrThread.start()
+def loadValidations():
+	try:
+		with open(VALIDATIONS_PATH, 'rb') as f:
+			return json.load(f)
+	except (IOError, ValueError):
+		return {}
+
+def saveValidations(validations):
+	if not os.path.exists(os.path.dirname(VALIDATIONS_PATH)):
+		os.mkdir(os.path.dirname(VALIDATIONS_PATH))
+	with open(VALIDATIONS_PATH + '.tmp', 'wb') as f:
+		json.dump(validations, f)
+	os.rename(VALIDATIONS_PATH + '.tmp', VALIDATIONS_PATH)
 
 def loadConfiguration():
 	config = ConfigParser.SafeConfigParser()
@@ -58,25 +155,240 @@ def service():
 		config.add_section('general')
 		config.set('general', 'quiet', json.dumps(False))
 		saveConfiguration(config)
+	# Plugins to run inside this process rather than as subprocesses
+	inProcess = set(json.loads(config.get('general', 'inprocess'))) if config.has_option('general', 'inprocess') else set()
 
 	# Do not error out on unencodable characters
-	encoder = pymorse.MorseCode(strict_mode=False)
+	encoder = morse.CompiledMorseCode(strict_mode=False)
 	# In case of unencodable characters:
 	# Try lossy conversion of unicode or accented characters to their nearest basic Latin character
+	normalizer = normalize.Normalizer()
 	def downconverter(text):
 		if isinstance(text, unicode):
-			return pymorse.MorseCode.to_morse(encoder, unidecode.unidecode(text))
+			return morse.CompiledMorseCode.to_morse(encoder, normalizer.normalize(text))
 		else:
-			return pymorse.MorseCode.to_morse(encoder, text)
+			return morse.CompiledMorseCode.to_morse(encoder, text)
 	encoder.to_morse = downconverter
 	# If that doesn't work, use a ?
 	encoder.missing_morse_code_placeholder = '?'
 
+	# Optionally abbreviate messages to save air time
+	encode = encoder.to_morse
+	compressor = None
+	if config.has_section('compress'):
+		options = dict((k, json.loads(v)) for (k, v) in config.items('compress'))
+		abbreviations = dict(compress.ABBREVIATIONS)
+		abbreviations.update(options.get('abbreviations', {}))
+		compressor = compress.Compressor(encoder, abbreviations, stripPrefixes=options.get('strip_prefixes', True), cutNumbers=options.get('cut_numbers', False))
+		# Each message's saving is logged, as a share of its air time
+		def encode(text):
+			(morseCode, saved) = compressor.compress(text)
+			if saved:
+				units = morse.units(morseCode) + saved
+				print >> sys.stderr, u'compress: saved {saved} of {units} units ({percent:.0f}%) on "{text}"'.format(saved=saved, units=units, percent=100.0 * saved / units, text=text).encode('utf-8')
+			return morseCode
+
+	# Synthesize the tones when configured to, otherwise use the wav/ samples
+	renderer = None
+	if config.has_section('synth'):
+		if synth is None:
+			print >> sys.stderr, 'numpy is required for [synth], using the wav/ samples instead'
+		else:
+			renderer = synth.fromConfig((k, json.loads(v)) for (k, v) in config.items('synth'))
+	# Speed up to keep the backlog short; only the synth's timing can change
+	governor = None
+	if config.has_section('speed'):
+		if renderer is None:
+			print >> sys.stderr, '[speed] requires [synth], keeping the speed of the wav/ samples'
+		else:
+			speed = dict((k, json.loads(v)) for (k, v) in config.items('speed'))
+			governor = synth.SpeedGovernor(renderer, target=speed.get('target', 60), maxWpm=speed.get('max_wpm', 40))
+
+	# Rendered audio for repeated messages, in memory and optionally on disk
+	options = dict((k, json.loads(v)) for (k, v) in config.items('cache')) if config.has_section('cache') else {}
+	renders = cache.RenderCache(maxBytes=int(options.get('memory_mb', 16) * 1024 * 1024), directory=cache.CACHE_DIR if options.get('disk', False) else None, maxDiskBytes=int(options.get('disk_mb', 256) * 1024 * 1024))
+
 	if not json.loads(config.get('general', 'quiet')):
-		sound.play(encoder.to_morse('Hello World'))
+		sound.play(encoder.to_morse('Hello World'), renderer=renderer)
+
+	# Everything below happens on this thread, which sleeps until a plugin
+	# line, a signal or a timer wakes it up
+	dispatcher = dispatch.Dispatcher()
+	dispatcher.stopOnSignals()
 
-	stdoutQueue = Queue.Queue()
-	stderrQueue = Queue.Queue()
+	# Timings for each stage of each message, and message rates; see
+	# stats.py.  They are reported on exit, and optionally every interval
+	# seconds and to anything connecting to a Unix socket.
+	options = dict((k, json.loads(v)) for (k, v) in config.items('stats')) if config.has_section('stats') else {}
+	timings = stats.Stats()
+	def report():
+		for line in timings.report():
+			print >> sys.stderr, 'stats: ' + line
+	def reportEvery(interval):
+		report()
+		dispatcher.callLater(interval, reportEvery, interval)
+	if options.get('interval'):
+		dispatcher.callLater(options['interval'], reportEvery, options['interval'])
+	statsSocket = None
+	if options.get('socket'):
+		statsSocket = stats.StatsSocket(dispatcher, os.path.expanduser(options['socket']), timings)
+
+	# Optionally give each plugin, or each priority, a voice of its own, with
+	# its own tone and place in the stereo field, and key them all at once
+	voices = None
+	if config.has_section('mixer'):
+		if mixer is None:
+			print >> sys.stderr, 'numpy is required for [mixer], playing one message at a time'
+		elif not getattr(sound.currentSink(), 'streams', False):
+			# The mix is written a fraction of a second at a time, which
+			# only a sink feeding a single player can play smoothly
+			print >> sys.stderr, '[mixer] requires aplay or SoX, playing one message at a time'
+		else:
+			options = dict((k, json.loads(v)) for (k, v) in config.items('mixer'))
+			renderer = renderer or synth.Synthesizer()
+			voices = mixer.Mixer(renderer.sampleRate)
+			voiceBy = options.get('by', 'plugin')
+			for (name, settings) in options.get('voices', {}).iteritems():
+				voices.voices[str(name)] = mixer.Voice(settings.get('frequency', renderer.frequency), settings.get('pan', 0.0))
+			voices.voices.setdefault('default', mixer.Voice(renderer.frequency))
+
+	def voiceOf(source, priority):
+		if voices is None:
+			return None
+		name = str(priority) if voiceBy == 'priority' else source
+		return name if name in voices.voices else 'default'
+
+	# Messages wait here until their turn to play, with a queue for each
+	# voice; see scheduler.py
+	options = dict((k, json.loads(v)) for (k, v) in config.items('scheduler')) if config.has_section('scheduler') else {}
+	priorities = options.get('priorities', {})
+	queues = {}
+	for name in (voices.voices if voices is not None else [None]):
+		queues[name] = scheduler.Scheduler((renderer or sound.bank).unitSeconds, backlog=options.get('backlog', 600), maxAge=options.get('max_age', 3600), summarize=options.get('summarize', True))
+		label = 'queue' if name is None else 'queue ' + name
+		timings.gauges[label + ' messages'] = queues[name].__len__
+		timings.gauges[label + ' seconds'] = queues[name].backlogSeconds
+	# The governor's speed, and the keying it has set the synth to
+	if governor is not None:
+		timings.gauges['speed'] = lambda: governor.speed
+		timings.gauges['speed wpm'] = lambda: renderer.wpm
+		timings.gauges['speed farnsworth'] = lambda: renderer.farnsworth or 0
+	state = {'playing': False}
+
+	# Repeats of a message still waiting are folded into it
+	options = dict((k, json.loads(v)) for (k, v) in config.items('coalesce')) if config.has_section('coalesce') else {}
+	coalescer = coalesce.Coalescer(ttl=options.get('ttl', 300), foldNumbers=options.get('fold_numbers', False), foldPrefixes=options.get('fold_prefixes', False))
+
+	# Returns the next message in the queue and its morse code
+	def nextMorseCode(queue):
+		message = queue.pop()
+		if message is None:
+			return (None, None)
+		morseCode = message.morseCode
+		if morseCode is None:
+			morseCode = encoder.to_morse(message.text)
+		else:
+			timings.record('queue', time.time() - message.received)
+		# Voices play in parallel, so the longest queue sets the latency
+		backlog = max(other.units for other in queues.itervalues())
+		if governor is not None and governor.update(backlog + morse.units(morseCode)):
+			print >> sys.stderr, 'speed: {wpm} wpm{farnsworth}, backlog {backlog:.0f}s'.format(wpm=renderer.wpm, farnsworth=' (farnsworth {f})'.format(f=renderer.farnsworth) if renderer.farnsworth else '', backlog=backlog * renderer.unitSeconds())
+		return (message, morseCode)
+
+	# Plays one message per pass of the dispatcher, so plugin output keeps
+	# being read, and prioritised, between messages
+	def playNext():
+		(message, morseCode) = nextMorseCode(queues[None])
+		if morseCode is None:
+			state['playing'] = False
+			return
+		sound.play(morseCode, renderer=renderer, cache=renders, stats=timings)
+		timings.record('total', time.time() - message.origin)
+		dispatcher.callSoon(playNext)
+
+	# With voices, each pass starts a message on any idle voice and plays a
+	# short block of the mix.  current holds the message on each busy voice.
+	current = {}
+	def mixNext():
+		for (name, voice) in voices.voices.iteritems():
+			if not voice.busy:
+				(message, morseCode) = nextMorseCode(queues[name])
+				if morseCode is not None:
+					rendered = time.time()
+					(params, frames) = renders.render(voice.synthesizer(renderer), morseCode)
+					timings.record('render', time.time() - rendered)
+					voice.start(frames)
+					current[name] = message
+		block = voices.mix()
+		if block is None:
+			state['playing'] = False
+			return
+		written = time.time()
+		sound.currentSink().write(*block)
+		timings.record('sink', time.time() - written)
+		for name in [name for name in current if not voices.voices[name].busy]:
+			timings.record('total', time.time() - current.pop(name).origin)
+		dispatcher.callSoon(mixNext)
+
+	# Subprocess plugins write UTF-8; in-process plugins hand over unicode
+	def onOutput(pluginName, line):
+		if not isinstance(line, unicode):
+			line = line.decode('utf-8', 'replace')
+		received = time.time()
+		(tags, text) = scheduler.parseTags(line)
+		timings.count(pluginName, received)
+		if 'ts' in tags:
+			timings.record('transport', max(0, received - tags['ts']))
+			if 'origin' in tags:
+				timings.record('source', max(0, tags['ts'] - tags['origin']))
+		text = text.strip()
+		print text.encode('utf-8')
+		(waiting, merged) = coalescer.merge(pluginName, text)
+		if waiting is not None:
+			morseCode = encode(merged)
+			queues[voiceOf(waiting.source, waiting.priority)].update(waiting, merged, morseCode, morse.units(morseCode))
+			return
+		encoded = time.time()
+		morseCode = encode(text)
+		timings.record('encode', time.time() - encoded)
+		deadline = time.time() + tags['deadline'] if 'deadline' in tags else None
+		message = scheduler.Message(text, morseCode, morse.units(morseCode), source=pluginName, priority=tags.get('priority', priorities.get(pluginName, 0)), deadline=deadline, origin=min(tags.get('origin', received), tags.get('ts', received), received))
+		queues[voiceOf(message.source, message.priority)].push(message)
+		coalescer.add(pluginName, text, message)
+		if not state['playing']:
+			state['playing'] = True
+			dispatcher.callSoon(playNext if voices is None else mixNext)
+
+	def onError(pluginName, line):
+		print >> sys.stderr, pluginName + ': ' + line.strip()
+
+	def startPlugin(pluginName, plugin, env):
+		if pluginName in inProcess and hasattr(plugin, 'messages'):
+			runPluginInProcess(pluginName, plugin, env, dispatcher, onOutput, onError)
+		else:
+			runPlugin(pluginName, plugin, env, dispatcher, onOutput, onError)
+
+	# Each plugin starts as soon as its own check passes
+	validations = loadValidations()
+	secret = loadSecret()
+	def onChecked(pluginName, plugin, env, result):
+		if result is None:
+			print >> sys.stderr, pluginName + ': configuration check timed out, starting anyway'
+		elif result:
+			validations[pluginName] = {'digest': configurationDigest(config, pluginName, secret), 'time': time.time()}
+			saveValidations(validations)
+		else:
+			print pluginName + ' requires configuration'
+			settings = plugin.configure(env)
+			config.remove_section(pluginName)
+			config.add_section(pluginName)
+			env = os.environ.copy()
+			for (k, v) in settings.iteritems():
+				config.set(pluginName, k.upper(), v)
+				env[k.upper()] = v
+			# Write out the config changes
+			saveConfiguration(config)
+		startPlugin(pluginName, plugin, env)
 
 	for pluginName in plugins.__dict__:
 		if not pluginName.startswith('_'):
@@ -89,32 +401,28 @@ def service():
 					env[k.upper()] = v
 			except ConfigParser.NoSectionError:
 				pass
+			# Lets the plugin keep state from its check for messages()
+			if pluginName in inProcess and hasattr(plugin, 'messages'):
+				env['MORSECOWBELL_INPROCESS'] = '1'
 
-			if not plugin.configured(env):
-				print pluginName + ' requires configuration'
-				settings = plugin.configure(env)
-				config.remove_section(pluginName)
-				config.add_section(pluginName)
-				env = os.environ.copy()
-				for (k, v) in settings.iteritems():
-					config.set(pluginName, k.upper(), v)
-					env[k.upper()] = v
-				# Write out the config changes
-				saveConfiguration(config)
-			
-			runPlugin(plugin, env, stdoutQueue, stderrQueue)
+			# Skip the check if the same configuration passed it recently
+			validation = validations.get(pluginName)
+			if validation and validation['digest'] == configurationDigest(config, pluginName, secret) and time.time() - validation['time'] < VALIDATION_TTL:
+				startPlugin(pluginName, plugin, env)
+			else:
+				checkPlugin(plugin, env, dispatcher, lambda result, pluginName=pluginName, plugin=plugin, env=env: onChecked(pluginName, plugin, env, result))
 
-	while True:
-		try:
-			print >> sys.stderr, stderrQueue.get_nowait().strip()
-		except Queue.Empty:
-			pass
-		try:
-			text = stdoutQueue.get_nowait().strip()
-			print text
-			sound.play(encoder.to_morse(text))
-		except Queue.Empty:
-			pass
+	dispatcher.run()
+	if statsSocket is not None:
+		statsSocket.close()
+	report()
+	if compressor is not None:
+		print >> sys.stderr, 'compression saved {saved} units over {messages} messages'.format(saved=compressor.saved, messages=compressor.messages)
+	print >> sys.stderr, 'coalesced {merged} repeated messages'.format(merged=coalescer.merged)
+	print >> sys.stderr, 'render cache: {hits} hits, {diskHits} disk hits, {misses} misses, {evictions} evictions'.format(**renders.stats())
+	for queue in queues.itervalues():
+		for ((source, reason), count) in sorted(queue.shed.iteritems()):
+			print >> sys.stderr, '{source}: {count} messages dropped ({reason})'.format(source=source, count=count, reason=reason)
 
 # Install and configure to start at boot/login
 def install():
@@ -1,18 +1,25 @@
+import distutils.spawn
+import errno
 import os
 import os.path
+import re
+import subprocess
 import sys
 import tempfile
+import time
 import wave
 
 DIT = os.path.abspath(os.path.join(os.path.dirname(__file__), 'wav', 'dit.wav'))
 DAH = os.path.abspath(os.path.join(os.path.dirname(__file__), 'wav', 'dah.wav'))
 GAP = os.path.abspath(os.path.join(os.path.dirname(__file__), 'wav', 'gap.wav'))
 
+# A word of morse code together with the word gap after it
+WORD = re.compile(r'.+?(?: {3,}|$)')
+
 try:
 	import winsound
 	_play = lambda filename: winsound.PlaySound(filename, None)
 except ImportError:
-	import subprocess
 	command = {
 		'darwin': 'afplay',
 	}.get(sys.platform, 'mpg123')
@@ -25,42 +32,237 @@ def bufferFilename(filename):
 	finally:
 		waveRead.close()
 
-def play(morseCode):
-	# Concatenate the files together
-	buffers = {}
+# Decoded samples for each morse symbol, kept in memory between messages.
+# The files are only parsed again when their size or mtime changes.
+class SampleBank(object):
+	def __init__(self, filenames):
+		self.filenames = filenames
+		self._stamps = {}
+		self.params = None
+		self.frames = {}
+
+	def _stamp(self, filename):
+		st = os.stat(filename)
+		return (st.st_mtime, st.st_size)
+
+	def refresh(self):
+		stamps = dict((symbol, self._stamp(filename)) for (symbol, filename) in self.filenames.iteritems())
+		if stamps == self._stamps:
+			return
+		params = None
+		frames = {}
+		for (symbol, filename) in self.filenames.iteritems():
+			(p, f) = bufferFilename(filename)
+			if params is not None and p[:3] != params[:3]:
+				raise ValueError('{filename} does not match the other samples: {p} versus {params}'.format(filename=filename, p=p, params=params))
+			params = p
+			frames[symbol] = f
+		(self.params, self.frames, self._stamps) = (params, frames, stamps)
+
+	# Identifies the current samples, for caching what was rendered from them
+	def key(self):
+		self.refresh()
+		return tuple(sorted(self._stamps.items()))
+
+	# Seconds per dit unit, for estimating air time; the dit sample
+	# includes its trailing gap
+	def unitSeconds(self):
+		self.refresh()
+		(nchannels, sampwidth, framerate) = self.params[:3]
+		return len(self.frames['.']) / float(nchannels * sampwidth * framerate) / 2
+
+	# Sizes the output from the symbol counts and fills it in a single pass,
+	# so the cost grows linearly with the length of the message
+	def render(self, morseCode):
+		self.refresh()
+		size = sum(morseCode.count(symbol) * len(sample) for (symbol, sample) in self.frames.iteritems())
+		frames = bytearray(size)
+		offset = 0
+		for character in morseCode:
+			sample = self.frames.get(character)
+			if sample is not None:
+				end = offset + len(sample)
+				frames[offset:end] = sample
+				offset = end
+		return (self.params, frames)
+
+bank = SampleBank({
+	'.': DIT,
+	'-': DAH,
+	' ': GAP,
+})
+
+# Sinks take (params, frames) as produced by a renderer.  The default is a
+# single long-lived player process which is fed raw PCM over its stdin, so
+# the per-message cost is a pipe write rather than a temp file and a fresh
+# player.  The temp file sink is kept for systems without such a player.
+#
+# Sinks with streams set can start playing before the rest of a message has
+# been rendered, so they are given it a word at a time.
+class NullSink(object):
+	streams = True
+
+	def write(self, params, frames):
+		pass
+
+	def close(self):
+		pass
+
+# Appends everything written to one WAV file, which is handy for tests
+class FileSink(object):
+	streams = True
+
+	def __init__(self, filename):
+		self.filename = filename
+		self._waveWrite = None
+
+	def write(self, params, frames):
+		if self._waveWrite is None:
+			self._waveWrite = wave.open(self.filename, 'wb')
+			self._waveWrite.setparams(params)
+		self._waveWrite.writeframes(frames)
+
+	def close(self):
+		if self._waveWrite is not None:
+			self._waveWrite.close()
+			self._waveWrite = None
+
+class TempFileSink(object):
+	def __init__(self, player=None):
+		self.player = player or _play
+
+	def write(self, params, frames):
+		filename = tempfile.NamedTemporaryFile().name
+		waveWrite = wave.open(filename, 'wb')
+		try:
+			waveWrite.setparams(params)
+			waveWrite.writeframes(frames)
+		finally:
+			waveWrite.close()
+		try:
+			self.player(filename)
+		finally:
+			os.remove(filename)
+
+	def close(self):
+		pass
+
+def aplayCommand(format):
+	(nchannels, sampwidth, framerate) = format
+	return ['aplay', '-q', '-t', 'raw', '-f', {1: 'U8', 2: 'S16_LE'}[sampwidth], '-r', str(framerate), '-c', str(nchannels)]
+
+def soxCommand(format):
+	(nchannels, sampwidth, framerate) = format
+	return ['play', '-q', '-t', 'raw', '-L', '-e', {1: 'unsigned', 2: 'signed'}[sampwidth], '-b', str(8 * sampwidth), '-r', str(framerate), '-c', str(nchannels), '-']
+
+PLAYERS = [
+	('aplay', aplayCommand),
+	('play', soxCommand),
+]
+
+class PipeSink(object):
+	streams = True
+
+	def __init__(self, command):
+		# command maps (nchannels, sampwidth, framerate) to an argument list
+		self.command = command
+		self._format = None
+		self._process = None
+
+	def _start(self, format):
+		self.close()
+		self._process = subprocess.Popen(self.command(format), stdin=subprocess.PIPE, close_fds=('posix' in sys.builtin_module_names))
+		self._format = format
+
+	def write(self, params, frames):
+		format = tuple(params[:3])
+		if format != self._format or self._process is None or self._process.poll() is not None:
+			self._start(format)
+		try:
+			self._process.stdin.write(frames)
+			self._process.stdin.flush()
+		except IOError as e:
+			if e.errno != errno.EPIPE:
+				raise
+			# The player went away; start another and try once more
+			self._start(format)
+			self._process.stdin.write(frames)
+			self._process.stdin.flush()
+
+	def close(self):
+		if self._process is not None:
+			try:
+				self._process.stdin.close()
+			except IOError:
+				pass
+			self._process.wait()
+			self._process = None
+			self._format = None
+
+def defaultSink():
+	if 'winsound' not in globals():
+		for (executable, command) in PLAYERS:
+			if distutils.spawn.find_executable(executable):
+				return PipeSink(command)
+	return TempFileSink()
+
+_sink = None
+
+# The sink messages are played to unless another is given
+def currentSink():
+	global _sink
+	if _sink is None:
+		_sink = defaultSink()
+	return _sink
+
+# Renders a word at a time; the chunks join up to the same audio as
+# rendering the whole message
+def renderChunks(renderer, morseCode):
+	for match in WORD.finditer(morseCode):
+		yield renderer.render(match.group())
+
+def joinChunks(chunks):
 	params = None
-	frames = None
-	for character in morseCode:
-		filename = {
-			'.': DIT,
-			'-': DAH,
-			' ': GAP,
-		}.get(character)
-		if filename is not None:
-			if filename not in buffers:
-				(p, f) = bufferFilename(filename)
-				buffers[filename] = f
-				if params is None:
-					params = p
-			if frames is None:
-				frames = buffers[filename]
-			else:
-				frames += buffers[filename]
-
-	# Write to temp file
-	filename = tempfile.NamedTemporaryFile().name
-	waveWrite = wave.open(filename, 'wb')
-	try:
-		waveWrite.setparams(params)
-		waveWrite.writeframes(frames)
-	finally:
-		waveWrite.close()
+	pieces = []
+	for (params, frames) in chunks:
+		pieces.append(frames)
+	if params is None:
+		return (None, b'')
+	frames = bytearray().join(pieces)
+	nframes = len(frames) // (params[0] * params[1])
+	return (tuple(params[:3]) + (nframes,) + tuple(params[4:]), frames)
 
-	# Play sound
-	try:
-		_play(filename)
-	finally:
-		os.remove(filename)
+# renderer is anything with a render(morseCode) method returning
+# (params, frames), such as the sample bank or a synth.Synthesizer; cache
+# is an optional cache.RenderCache; stats is an optional stats.Stats, which
+# is given the seconds spent rendering and writing to the sink
+def play(morseCode, sink=None, renderer=None, cache=None, stats=None):
+	sink = sink or currentSink()
+	renderer = renderer or bank
+	rendered = time.time()
+	if getattr(sink, 'streams', False):
+		# The first word plays while the rest are rendered
+		chunks = cache.chunks(renderer, morseCode) if cache is not None else renderChunks(renderer, morseCode)
+		(rendering, writing) = (0, 0)
+		for (params, frames) in chunks:
+			written = time.time()
+			rendering += written - rendered
+			sink.write(params, frames)
+			rendered = time.time()
+			writing += rendered - written
+		rendering += time.time() - rendered
+	else:
+		if cache is not None:
+			(params, frames) = cache.render(renderer, morseCode)
+		else:
+			(params, frames) = renderer.render(morseCode)
+		written = time.time()
+		rendering = written - rendered
+		sink.write(params, frames)
+		writing = time.time() - written
+	if stats is not None:
+		stats.record('render', rendering)
+		stats.record('sink', writing)
 
 if __name__ == '__main__':
 	play('... --- ...')
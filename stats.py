@@ -0,0 +1,160 @@
+import collections
+import json
+import os
+import socket
+import time
+
+# The stages a message passes through on its way from a plugin to the
+# player, in order:
+#
+#     source     the event happening to the plugin noticing it, such as a
+#                mail reaching the IMAP server to imap_email fetching it
+#     transport  the plugin writing the line to the service reading it
+#     encode     downconverting, compressing and encoding into morse
+#     queue      waiting in the scheduler to be played
+#     render     assembling the audio, or finding it in the cache
+#     sink       handing the audio to the player
+#     total      the earliest time known for the message to its audio
+#                having been handed to the player
+#
+# source and transport are only known for lines carrying the origin and ts
+# tags; see scheduler.py.
+STAGES = ('source', 'transport', 'encode', 'queue', 'render', 'sink', 'total')
+PERCENTILES = (50, 95, 99)
+
+# The value below which the given percentage of the sorted values fall
+def percentile(values, percent):
+	return values[min(len(values) - 1, int(percent / 100.0 * len(values)))]
+
+# The most recent size samples of a duration, in a ring, so recording one is
+# a store and an increment and the percentiles follow recent behaviour
+# rather than the whole run.  Sorting happens only when a report is made.
+class Histogram(object):
+	def __init__(self, size=1024):
+		self.size = size
+		self.count = 0
+		self._samples = []
+
+	def add(self, value):
+		if len(self._samples) < self.size:
+			self._samples.append(value)
+		else:
+			self._samples[self.count % self.size] = value
+		self.count += 1
+
+	def summary(self):
+		if not self._samples:
+			return None
+		values = sorted(self._samples)
+		summary = dict(('p{percent}'.format(percent=percent), percentile(values, percent)) for percent in PERCENTILES)
+		summary.update(count=self.count, max=values[-1])
+		return summary
+
+# Events per second over the last window seconds, counted in one bucket per
+# second so the memory used does not grow with the rate
+class Rate(object):
+	def __init__(self, window=60):
+		self.window = window
+		self.count = 0
+		self._buckets = collections.deque()
+
+	def add(self, now):
+		second = int(now)
+		if self._buckets and self._buckets[-1][0] == second:
+			self._buckets[-1][1] += 1
+		else:
+			self._buckets.append([second, 1])
+		self.count += 1
+
+	def perSecond(self, now):
+		while self._buckets and self._buckets[0][0] <= now - self.window:
+			self._buckets.popleft()
+		return sum(count for (_, count) in self._buckets) / float(self.window)
+
+# Latency histograms for each stage, message rates for each plugin, and
+# gauges, such as queue depths, which are read only when a report is made.
+# Recording is cheap enough to leave on all the time.
+class Stats(object):
+	def __init__(self, size=1024, window=60):
+		self.size = size
+		self.window = window
+		self.started = time.time()
+		self.stages = {}
+		self.rates = {}
+		self.gauges = {}
+
+	def record(self, stage, seconds):
+		histogram = self.stages.get(stage)
+		if histogram is None:
+			histogram = self.stages[stage] = Histogram(self.size)
+		histogram.add(seconds)
+
+	def count(self, source, now=None):
+		rate = self.rates.get(source)
+		if rate is None:
+			rate = self.rates[source] = Rate(self.window)
+		rate.add(now or time.time())
+
+	def snapshot(self):
+		now = time.time()
+		stages = {}
+		for (stage, histogram) in self.stages.iteritems():
+			stages[stage] = histogram.summary()
+		return {
+			'uptime': now - self.started,
+			'stages': stages,
+			'plugins': dict((source, {'messages': rate.count, 'perSecond': rate.perSecond(now)}) for (source, rate) in self.rates.iteritems()),
+			'gauges': dict((name, gauge()) for (name, gauge) in self.gauges.iteritems()),
+		}
+
+	# One line per stage, plugin and gauge
+	def report(self):
+		snapshot = self.snapshot()
+		lines = []
+		order = [stage for stage in STAGES if stage in snapshot['stages']] + sorted(set(snapshot['stages']) - set(STAGES))
+		for stage in order:
+			summary = snapshot['stages'][stage]
+			lines.append('{stage}: {count} samples, {percentiles}, max {max:.1f}ms'.format(stage=stage, count=summary['count'], max=summary['max'] * 1000, percentiles=', '.join('p{percent} {value:.1f}ms'.format(percent=percent, value=summary['p{percent}'.format(percent=percent)] * 1000) for percent in PERCENTILES)))
+		for (source, rate) in sorted(snapshot['plugins'].iteritems()):
+			lines.append('{source}: {messages} messages, {perMinute:.1f} per minute'.format(source=source, messages=rate['messages'], perMinute=rate['perSecond'] * 60))
+		for (name, value) in sorted(snapshot['gauges'].iteritems()):
+			lines.append('{name}: {value:g}'.format(name=name, value=value))
+		return lines
+
+# Answers each connection to a Unix socket with a JSON snapshot of the
+# stats, then closes it, so they can be read while the service runs:
+#
+#     nc -U ~/.morsecowbell/stats.sock
+class StatsSocket(object):
+	def __init__(self, dispatcher, path, stats):
+		self.dispatcher = dispatcher
+		self.path = path
+		self.stats = stats
+		if os.path.exists(path):
+			os.remove(path)
+		self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		self.socket.bind(path)
+		self.socket.listen(5)
+		self.socket.setblocking(False)
+		dispatcher.addReader(self.socket.fileno(), self._onReadable)
+
+	def _onReadable(self):
+		try:
+			(connection, _) = self.socket.accept()
+		except socket.error:
+			return
+		try:
+			connection.setblocking(True)
+			connection.sendall(json.dumps(self.stats.snapshot(), sort_keys=True) + '\n')
+		except socket.error:
+			pass
+		finally:
+			connection.close()
+
+	def close(self):
+		self.dispatcher.removeReader(self.socket.fileno())
+		self.socket.close()
+		try:
+			os.remove(self.path)
+		except OSError:
+			pass
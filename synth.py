@@ -0,0 +1,146 @@
+import math
+import re
+
+import numpy
+
+# Token pattern for strings produced by MorseCode.to_morse: each dit or dah
+# is a token, and so is each run of separator spaces
+TOKENS = re.compile(r'[.-]| +')
+
+# Element waveforms for each parameter set, shared by every Synthesizer
+_elements = {}
+
+# Generates Morse audio procedurally rather than from the samples in wav/.
+# Timing follows the PARIS standard: a dit is 1.2 / wpm seconds, a dah is
+# three dits, and elements, characters and words are separated by one,
+# three and seven dits of silence.  With a Farnsworth speed below wpm the
+# characters keep their shape but the gaps between them are stretched so
+# the overall rate matches the Farnsworth speed.
+class Synthesizer(object):
+	def __init__(self, wpm=20, farnsworth=None, frequency=700, sampleRate=8000, rampMs=5, amplitude=0.8):
+		self.wpm = wpm
+		self.farnsworth = farnsworth
+		self.frequency = frequency
+		self.sampleRate = sampleRate
+		self.rampMs = rampMs
+		self.amplitude = amplitude
+
+	def key(self):
+		return (self.wpm, self.farnsworth, self.frequency, self.sampleRate, self.rampMs, self.amplitude)
+
+	def params(self, nframes=0):
+		return (1, 2, self.sampleRate, nframes, 'NONE', 'not compressed')
+
+	def gaps(self):
+		unit = 1.2 / self.wpm
+		if self.farnsworth is None or self.farnsworth >= self.wpm:
+			return (unit, 3 * unit, 7 * unit)
+		# ARRL Farnsworth timing: total extra delay per PARIS word, split
+		# between the character and word gaps in the ratio 3:7
+		delay = (60.0 * self.wpm - 37.2 * self.farnsworth) / (self.farnsworth * self.wpm)
+		return (unit, 3 * delay / 19, 7 * delay / 19)
+
+	# Average seconds per dit unit, taking Farnsworth spacing into account
+	def unitSeconds(self):
+		return 1.2 / min(self.wpm, self.farnsworth or self.wpm)
+
+	def _samples(self, seconds):
+		return int(round(seconds * self.sampleRate))
+
+	def _tone(self, seconds):
+		n = self._samples(seconds)
+		t = numpy.arange(n) / float(self.sampleRate)
+		tone = numpy.sin(2 * numpy.pi * self.frequency * t)
+		# Raised-cosine keying envelope to avoid clicks
+		ramp = min(self._samples(self.rampMs / 1000.0), n // 2)
+		if ramp > 0:
+			shape = 0.5 * (1 - numpy.cos(numpy.pi * numpy.arange(ramp) / ramp))
+			tone[:ramp] *= shape
+			tone[n - ramp:] *= shape[::-1]
+		return (tone * self.amplitude * 32767).astype('<i2')
+
+	def _silence(self, seconds):
+		return numpy.zeros(max(0, self._samples(seconds)), dtype='<i2')
+
+	def elements(self):
+		key = self.key()
+		elements = _elements.get(key)
+		if elements is None:
+			(unit, charGap, wordGap) = self.gaps()
+			# Every dit and dah carries its trailing element gap, so the
+			# character and word gaps only add what is left over
+			elements = {
+				'.': numpy.concatenate([self._tone(unit), self._silence(unit)]),
+				'-': numpy.concatenate([self._tone(3 * unit), self._silence(unit)]),
+				'char': self._silence(charGap - unit),
+				'word': self._silence(wordGap - unit),
+			}
+			_elements[key] = elements
+		return elements
+
+	def _sequence(self, morseCode):
+		elements = self.elements()
+		for token in TOKENS.findall(morseCode):
+			if token in elements:
+				yield elements[token]
+			elif len(token) >= 3:
+				yield elements['word']
+			else:
+				yield elements['char']
+
+	def render(self, morseCode):
+		pieces = list(self._sequence(morseCode))
+		if not pieces:
+			return (self.params(), b'')
+		frames = numpy.concatenate(pieces)
+		return (self.params(len(frames)), frames.tostring())
+
+# Raises the keying speed when the queued morse would take longer than
+# target seconds to play, and eases it back down as the backlog clears.
+# Farnsworth gaps are tightened first, which keeps the character shapes the
+# listener is used to, and then wpm rises up to maxWpm.  Speeds are whole
+# words per minute so only a few element sets end up in _elements.
+class SpeedGovernor(object):
+	def __init__(self, synthesizer, target=60, maxWpm=40, step=2):
+		self.synthesizer = synthesizer
+		self.target = target
+		self.step = step
+		self.wpm = synthesizer.wpm
+		self.farnsworth = synthesizer.farnsworth if synthesizer.farnsworth and synthesizer.farnsworth < synthesizer.wpm else None
+		self.minSpeed = self.farnsworth or self.wpm
+		self.maxWpm = max(maxWpm, self.wpm)
+		self.speed = self.minSpeed
+
+	# units is the queued morse in dit units; returns True if the speed changed
+	def update(self, units):
+		wanted = int(math.ceil(units * 1.2 / self.target))
+		wanted = min(max(wanted, self.minSpeed), self.maxWpm)
+		if wanted > self.speed:
+			speed = min(wanted, self.speed + self.step)
+		else:
+			# Slow down gently, a word per minute per message
+			speed = max(wanted, self.speed - 1)
+		if speed == self.speed:
+			return False
+		self.speed = speed
+		if speed > self.wpm:
+			(self.synthesizer.wpm, self.synthesizer.farnsworth) = (speed, None)
+		elif self.farnsworth is not None and speed < self.wpm:
+			(self.synthesizer.wpm, self.synthesizer.farnsworth) = (self.wpm, speed)
+		else:
+			(self.synthesizer.wpm, self.synthesizer.farnsworth) = (self.wpm, None)
+		return True
+
+# ConfigParser lowercases option names, so the [synth] section spells them
+# with underscores
+OPTIONS = {
+	'wpm': 'wpm',
+	'farnsworth': 'farnsworth',
+	'frequency': 'frequency',
+	'sample_rate': 'sampleRate',
+	'ramp_ms': 'rampMs',
+	'amplitude': 'amplitude',
+}
+
+def fromConfig(items):
+	return Synthesizer(**{OPTIONS[k]: v for (k, v) in items})